@@ -1,20 +1,12 @@
 import cv2
-import numpy as np
-import insightface
-from insightface.app import FaceAnalysis
-import os
 
-def swap_face(source_img_path, target_img_path, output_path, model_path):
-    """简化版的换脸函数"""
-    # 初始化人脸检测器
-    model_dir = '/data/xxtcode/ltz/faceswap_setup/models'
-    os.environ['INSIGHTFACE_HOME'] = model_dir
+from engine import get_engine
 
-    app = FaceAnalysis(name='buffalo_l', root=model_dir, providers=['CPUExecutionProvider'])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    
-    # 加载换脸模型
-    swapper = insightface.model_zoo.get_model(model_path)
+def swap_face(source_img_path, target_img_path, output_path, model_path=None):
+    """简化版的换脸函数"""
+    # 共享引擎：同一进程内多次调用只加载一次模型；模型目录见 config.MODEL_DIR（FACESWAP_MODEL_DIR），
+    # model_path 为空时使用其中的 inswapper_128.onnx；检测阈值见 config.DET_THRESH（FACESWAP_DET_THRESH）
+    engine = get_engine(swapper_path=model_path) if model_path else get_engine()
 
     # 读取图片
     source = cv2.imread(source_img_path)
@@ -26,18 +18,18 @@ def swap_face(source_img_path, target_img_path, output_path, model_path):
         raise Exception(f"Could not load target image: {target_img_path}")
 
     # 检测人脸
-    source_faces = app.get(source)
+    source_faces = engine.detect(source, profile='source')
     if len(source_faces) == 0:
         raise Exception("No face found in source image")
     source_face = source_faces[0]
     
-    target_faces = app.get(target)
+    target_faces = engine.detect(target, profile='target')
     if len(target_faces) == 0:
         raise Exception("No face found in target image")
     target_face = target_faces[0]
 
     # 执行换脸
-    result = swapper.get(target, target_face, source_face)
+    result = engine.swap(target, target_face, source_face)
     
     # 保存结果
     cv2.imwrite(output_path, result)
@@ -49,11 +41,9 @@ if __name__ == "__main__":
         print("Usage: python face_swap.py <source_image> <target_image> <output_image>")
         sys.exit(1)
 
-    # 设置模型路径
-    model_path = "/data/xxtcode/ltz/faceswap_setup/models/inswapper_128.onnx"
-    
+    # 批量处理请使用 bulk.py
     try:
-        result = swap_face(sys.argv[1], sys.argv[2], sys.argv[3], model_path)
+        result = swap_face(sys.argv[1], sys.argv[2], sys.argv[3])
         print(result)
     except Exception as e:
         print(f"Error: {str(e)}")
\ No newline at end of file
@@ -1,14 +1,76 @@
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, Response, request, render_template_string, jsonify, url_for, stream_with_context, g, send_file, send_from_directory
 from flask_cors import CORS
-import cv2
-import numpy as np
-import insightface
-from insightface.app import FaceAnalysis
-import os
 import base64
+import json
+import logging
+import os
+import time
+import uuid
+
+import config
+import live
+import metrics
+from encoding import Encoded, OutputOptions, sniff_mimetype
+from ingest import ImageRejected
+from jobs import FileResult, JobQueue, QueueFull, report_progress
+from logs import setup_logging
+from pipeline import decode_upload, parse_face_mapping, result_signature, source_cache, swap_roles, warm_up
+from result_cache import KEY_PATTERN, ResultCache, result_key
+from role_assets import RoleThumbnails
+from roles import catalog, video_catalog
+from source_cache import content_key
+from video import swap_video
+from worker_pool import WorkerPool
+
+try:
+    from flask_sock import Sock
+except ImportError:  # 实时换脸是可选功能，没有安装 flask-sock 时不提供 /live
+    Sock = None
 
 app = Flask(__name__)
+# 请求体超过上限时在读取之前返回 413
+app.config['MAX_CONTENT_LENGTH'] = config.UPLOAD_MAX_MB * 1024 * 1024
 CORS(app)
+sock = Sock(app) if Sock is not None else None
+
+logger = logging.getLogger(__name__)
+
+# 上传前在浏览器端处理图片：按 /api/upload-limits 给出的上限缩小并重新压缩，两个页面共用
+UPLOAD_SCRIPT = '''
+        let uploadLimits = null;
+
+        // 返回实际上传的图片（Blob），长边超过上限或格式服务器不支持时在 canvas 上缩小并重新压缩，
+        // 任何一步失败都上传原文件
+        async function prepareUpload(file) {
+            try {
+                if (!uploadLimits) {
+                    uploadLimits = fetch('/api/upload-limits').then(response => response.json());
+                }
+                const limits = await uploadLimits;
+                // 按 EXIF 方向转正后再缩小，重新压缩的图片不带 EXIF
+                const bitmap = await createImageBitmap(file, {imageOrientation: 'from-image'});
+                const scale = Math.min(1, limits.max_side / Math.max(bitmap.width, bitmap.height));
+                const accepted = limits.types.includes(file.type);
+                if (scale === 1 && accepted && file.size <= limits.max_bytes) {
+                    bitmap.close();
+                    return file;
+                }
+                const canvas = document.createElement('canvas');
+                canvas.width = Math.max(1, Math.round(bitmap.width * scale));
+                canvas.height = Math.max(1, Math.round(bitmap.height * scale));
+                const context = canvas.getContext('2d');
+                context.imageSmoothingQuality = 'high';
+                context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+                bitmap.close();
+                const blob = await new Promise(resolve => canvas.toBlob(resolve, limits.format, limits.quality));
+                if (!blob || (scale === 1 && accepted && blob.size >= file.size)) return file;
+                return blob;
+            } catch (error) {
+                console.warn('图片预处理失败，上传原图:', error);
+                return file;
+            }
+        }
+'''
 
 # HTML模板 - 直接嵌入Python文件中
 HTML_TEMPLATE = '''
@@ -215,7 +277,9 @@ HTML_TEMPLATE = '''
         let selectedRole = null;
         let selectedGender = null;
         let userImage = null;
-
+        // 选择照片后立即开始预处理，点击换脸时等待结果
+        let userUpload = null;
+{{ upload_script|safe }}
         // 获取元素引用
         const fileInput = document.getElementById('userPhoto');
         const uploadBtn = document.getElementById('uploadBtn');
@@ -224,18 +288,20 @@ HTML_TEMPLATE = '''
         // 处理文件上传
         fileInput.addEventListener('change', function(e) {
             const file = e.target.files[0];
+            // 预览直接引用本地文件，不再转成 base64
+            if (preview.src.startsWith('blob:')) {
+                URL.revokeObjectURL(preview.src);
+            }
             if (file) {
-                const reader = new FileReader();
-                reader.onload = function(e) {
-                    userImage = e.target.result;
-                    preview.src = userImage;
-                    preview.style.display = 'block';
-                    uploadBtn.textContent = '重新选择';
-                    updateSwapButton();
-                };
-                reader.readAsDataURL(file);
+                userImage = file;
+                userUpload = prepareUpload(file);
+                preview.src = URL.createObjectURL(file);
+                preview.style.display = 'block';
+                uploadBtn.textContent = '重新选择';
+                updateSwapButton();
             } else {
                 userImage = null;
+                userUpload = null;
                 preview.src = '';
                 preview.style.display = 'none';
                 uploadBtn.textContent = '选择照片';
@@ -266,7 +332,8 @@ HTML_TEMPLATE = '''
                         roleDiv.dataset.role = roleId;
                         
                         roleDiv.innerHTML = `
-                            <img src="${role.path}" alt="${role.name}">
+                            <img src="${role.thumbnail || role.path}" srcset="${role.srcset || ''}"
+                                 sizes="(max-width: 480px) 100vw, 300px" loading="lazy" decoding="async" alt="${role.name}">
                             <p>${role.name}</p>
                         `;
                         
@@ -329,27 +396,31 @@ HTML_TEMPLATE = '''
             loading.style.display = 'block';
             
             try {
+                // 以 multipart/form-data 上传预处理后的图片，结果以二进制图片返回
+                const upload = await userUpload;
+                const formData = new FormData();
+                formData.append('image', upload, upload === userImage ? userImage.name : 'upload.jpg');
+                formData.append('gender', selectedGender);
+                formData.append('role', selectedRole);
+
                 const response = await fetch('/swap', {
                     method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify({
-                        image: userImage,
-                        gender: selectedGender,
-                        role: selectedRole
-                    })
+                    body: formData
                 });
 
-                const data = await response.json();
-                
-                if (data.error) {
+                if (!response.ok) {
+                    const data = await response.json();
                     alert(data.error);
                     return;
                 }
 
+                const resultImg = document.querySelector('#result img');
+                if (resultImg) {
+                    URL.revokeObjectURL(resultImg.src);
+                }
+                const resultUrl = URL.createObjectURL(await response.blob());
                 const resultDiv = document.getElementById('result');
-                resultDiv.innerHTML = `<img src="${data.image}" alt="换脸结果">`;
+                resultDiv.innerHTML = `<img src="${resultUrl}" alt="换脸结果">`;
             } catch (error) {
                 alert('换脸失败：' + error.message);
             } finally {
@@ -364,183 +435,566 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-# 角色图片配置
-ROLES = {
-    'male': {
-        'soldier': {
-            'path': '/static/roles/male/soldier.jpg',  # 注意这里要加上前导斜杠
-            'name': '军人'
-        },
-        'doctor': {
-            'path': '/static/roles/male/doctor.png',
-            'name': '医生'
-        },
-        'teacher': {
-            'path': '/static/roles/male/teacher.jpg',
-            'name': '老师'
-        },
-        # 'aisha': {
-        #     'path': '/static/roles/male/aoteman.png',
-        #     'name': '奥特曼'
-        # }
-    },
-    'female': {
-        'nurse': {
-            'path': '/static/roles/female/nurse.jpg',
-            'name': '护士'
-        },
-        'doctor': {
-            'path': '/static/roles/female/doctor.jpg',
-            'name': '医生'
-        },
-        'teacher': {
-            'path': '/static/roles/female/teacher.jpeg',
-            'name': '老师'
-        },
-        # 'student': {
-        #     'path': '/static/roles/female/aisha.png',
-        #     'name': '艾莎'
-        # }
-    }
-}
-
-def swap_face(source_img, target_img_path, source_is_base64=False):
-    """换脸函数"""
-    # 初始化人脸检测器
-    model_dir = './models'
-    os.environ['INSIGHTFACE_HOME'] = model_dir
-
-    app = FaceAnalysis(name='buffalo_l', 
-                      root=model_dir, 
-                      providers=['CPUExecutionProvider'])
-    
-    # 修改检测参数，提高灵敏度
-    app.prepare(ctx_id=0, 
-               det_size=(640, 640),  # 降低检测尺寸，提高灵敏度
-               det_thresh=0.3)       # 降低检测阈值，提高检测灵敏度
-
-    # 加载换脸模型 - 添加这部分
-    model_path = "./models/inswapper_128.onnx"
-    swapper = insightface.model_zoo.get_model(model_path)
-
-    try:
-        # 处理源图片
-        if source_is_base64:
-            img_data = base64.b64decode(source_img.split('base64,')[1])
-            nparr = np.frombuffer(img_data, np.uint8)
-            source = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        else:
-            source = cv2.imread(source_img)
-
-        if source is None:
-            raise Exception("无法加载源图片")
-
-        # 读取目标图片
-        target = cv2.imread(target_img_path)
-        if target is None:
-            raise Exception("无法加载目标图片")
-
-        # 添加调试信息
-        print(f"源图片尺寸: {source.shape}")
-        print(f"目标图片尺寸: {target.shape}")
-
-        # 图片预处理 - 调整大小
-        if source.shape[0] < 800 or source.shape[1] < 800:
-            scale = max(800/source.shape[0], 800/source.shape[1])
-            source = cv2.resize(source, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
-        elif source.shape[0] > 2000 or source.shape[1] > 2000:
-            scale = min(2000/source.shape[0], 2000/source.shape[1])
-            source = cv2.resize(source, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-
-        # 检测人脸前的图像预处理
-        # 1. 确保图像是BGR格式
-        if len(source.shape) == 2:  # 如果是灰度图
-            source = cv2.cvtColor(source, cv2.COLOR_GRAY2BGR)
-        
-        # 2. 调整亮度和对比度
-        source = cv2.convertScaleAbs(source, alpha=1.1, beta=10)
-
-        # 3. 添加调试信息
-        print("开始检测人脸...")
-        
-        # 检测人脸
-        source_faces = app.get(source)
-        print(f"检测到 {len(source_faces)} 个人脸")
-        
-        if len(source_faces) == 0:
-            # 保存问题图片以供分析
-            debug_path = "debug_source.jpg"
-            cv2.imwrite(debug_path, source)
-            raise Exception(f"未在源图片中检测到人脸，已保存问题图片到 {debug_path}")
-            
-        target_faces = app.get(target)
-        if len(target_faces) == 0:
-            raise Exception("未在目标图片中检测到人脸")
-
-        # 执行换脸
-        result = swapper.get(target, target_faces[0], source_faces[0])
-        
-        # 确保结果不为空
-        if result is None:
-            raise Exception("换脸处理失败")
-
-        # 简化后处理步骤，只保留必要的处理
-        # 1. 轻微提升亮度和对比度
-        result = cv2.convertScaleAbs(result, alpha=1.05, beta=3)
-
-        # 2. 保存高质量图片
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 95]
-        success, buffer = cv2.imencode('.jpg', result, encode_param)
-        
-        if not success:
-            raise Exception("图片编码失败")
+# 实时换脸页面：摄像头画面按目标帧率通过 WebSocket 发送，显示服务器返回的换脸结果
+LIVE_TEMPLATE = '''
+<!DOCTYPE html>
+<html>
+<head>
+    <title>实时换脸</title>
+    <style>
+        body { font-family: Arial, sans-serif; background-color: #f5f5f5; margin: 0; padding: 20px; }
+        .container { max-width: 1200px; margin: 0 auto; padding: 20px; background: white; border-radius: 10px; }
+        .views { display: flex; gap: 20px; }
+        .views video, .views img { width: 50%; border-radius: 8px; background: #000; }
+        #stats { color: #666; margin: 10px 0; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>实时换脸</h1>
+        <input type="file" id="sourcePhoto" accept="image/*">
+        <button id="startButton" disabled>开始</button>
+        <div id="stats"></div>
+        <div class="views">
+            <video id="camera" autoplay muted playsinline></video>
+            <img id="output" alt="换脸结果">
+        </div>
+    </div>
+    <script>
+        const FPS = {{ fps }};
+        const camera = document.getElementById('camera');
+        const output = document.getElementById('output');
+        const stats = document.getElementById('stats');
+        const startButton = document.getElementById('startButton');
+        const canvas = document.createElement('canvas');
+        let source = null;
+{{ upload_script|safe }}
+        document.getElementById('sourcePhoto').addEventListener('change', async function(e) {
+            const reader = new FileReader();
+            reader.onload = () => { source = reader.result; startButton.disabled = false; };
+            reader.readAsDataURL(await prepareUpload(e.target.files[0]));
+        });
 
-        return base64.b64encode(buffer).decode('utf-8')
+        startButton.addEventListener('click', async function() {
+            startButton.disabled = true;
+            camera.srcObject = await navigator.mediaDevices.getUserMedia({video: true});
+            const ws = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/live/ws');
+            ws.binaryType = 'blob';
+            let timer = null;
+            ws.onopen = () => ws.send(JSON.stringify({source: source, fps: FPS}));
+            ws.onmessage = (event) => {
+                if (event.data instanceof Blob) {
+                    if (output.src.startsWith('blob:')) URL.revokeObjectURL(output.src);
+                    output.src = URL.createObjectURL(event.data);
+                    return;
+                }
+                const message = JSON.parse(event.data);
+                if (message.type === 'ready') {
+                    timer = setInterval(sendFrame, 1000 / FPS);
+                } else if (message.type === 'frame') {
+                    stats.textContent = `延迟 ${message.latency_ms} ms，丢弃 ${message.dropped} 帧，处理分辨率 ${message.scale}`;
+                } else if (message.type === 'error') {
+                    stats.textContent = message.error;
+                }
+            };
+            ws.onclose = () => { clearInterval(timer); startButton.disabled = false; };
+
+            function sendFrame() {
+                // 上一帧还没发出去时跳过，避免在浏览器端积压
+                if (ws.readyState !== WebSocket.OPEN || ws.bufferedAmount > 0 || !camera.videoWidth) return;
+                canvas.width = camera.videoWidth;
+                canvas.height = camera.videoHeight;
+                canvas.getContext('2d').drawImage(camera, 0, 0);
+                canvas.toBlob(blob => ws.send(blob), 'image/jpeg', 0.8);
+            }
+        });
+    </script>
+</body>
+</html>
+'''
 
-    except Exception as e:
-        print(f"换脸处理错误: {str(e)}")  # 添加错误日志
-        raise e
+# 异步换脸任务队列
+job_queue = JobQueue(workers=config.JOB_WORKERS,
+                     max_queued=config.JOB_QUEUE_SIZE,
+                     result_ttl=config.JOB_RESULT_TTL)
+
+# 多进程模式：换脸交给预先加载好模型的工作进程，0 表示在当前进程内执行
+worker_pool = WorkerPool(workers=config.WORKER_PROCESSES,
+                         onnx_threads=config.WORKER_ONNX_THREADS) if config.WORKER_PROCESSES > 0 else None
+
+# 换脸结果的磁盘缓存，相同的上传图片和角色直接返回保存的结果
+result_cache = ResultCache(config.RESULT_CACHE_DIR, config.RESULT_CACHE_MAX_MB * 1024 * 1024)
+# 角色图库缩略图
+role_thumbnails = RoleThumbnails(catalog)
+
+# 监控指标
+HTTP_REQUESTS = metrics.Counter('faceswap_http_requests_total', '按接口和结果统计的请求数',
+                                ['endpoint', 'outcome'])
+HTTP_SECONDS = metrics.Histogram('faceswap_http_request_seconds', '按接口统计的请求耗时（秒）', ['endpoint'])
+SWAPS_IN_FLIGHT = metrics.Gauge('faceswap_swaps_in_flight', '正在执行的换脸数')
+metrics.Gauge('faceswap_job_queue_depth', '排队中的异步任务数', function=lambda: {(): job_queue.depth})
+metrics.Gauge('faceswap_jobs_running', '执行中的异步任务数', function=lambda: {(): job_queue.running})
+metrics.Gauge('faceswap_worker_pool_pending', '已提交给工作进程、尚未完成的换脸数',
+              function=lambda: {(): worker_pool.pending if worker_pool is not None else 0})
+metrics.CounterFunction('faceswap_cache_requests_total', '缓存查询次数（多进程模式下源人脸缓存位于工作进程中，不在此统计）',
+                        ['cache', 'result'],
+                        function=lambda: {('source', 'hit'): source_cache.hits,
+                                          ('source', 'miss'): source_cache.misses,
+                                          ('result', 'hit'): result_cache.hits,
+                                          ('result', 'miss'): result_cache.misses})
+
+def request_outcome(status_code):
+    if status_code == 429:
+        return 'rejected'
+    if status_code >= 500:
+        return 'error'
+    if status_code >= 400:
+        return 'client_error'
+    return 'success'
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    if endpoint != 'get_metrics':
+        HTTP_REQUESTS.inc(endpoint=endpoint, outcome=request_outcome(response.status_code))
+        HTTP_SECONDS.observe(time.perf_counter() - g.start_time, endpoint=endpoint)
+    return response
+
+def run_swap(source_image, gender, roles, source_is_base64=False, faces=None, output=None):
+    """执行换脸，返回与 roles 顺序一致的 Encoded 列表"""
+    with SWAPS_IN_FLIGHT.track():
+        if worker_pool is None:
+            return swap_roles(source_image, gender, roles, source_is_base64=source_is_base64,
+                              faces=faces, output=output)
+        # 在前端进程解码，解码结果通过共享内存交给工作进程
+        image, cache_key = decode_upload(source_image, source_is_base64)
+        return worker_pool.swap(image, cache_key, gender, roles, faces=faces, output=output)
+
+def preview_key(key):
+    """预览图的缓存键"""
+    return result_key(key, 'preview')
+
+def cached_result(key, with_preview):
+    """从结果缓存读取完整图片（和预览图），任何一个缺失都按未命中处理"""
+    data = result_cache.get(key)
+    if data is None:
+        return None
+    preview = None
+    if with_preview:
+        preview = result_cache.get(preview_key(key))
+        if preview is None:
+            return None
+    return Encoded(data, preview)
+
+def swap_cached(source_image, gender, roles, source_is_base64=False, faces=None, output=None):
+    """换脸，结果按上传内容、角色、人脸对应方式、输出参数和流程参数缓存
+
+    返回与 roles 顺序一致的 [(结果哈希, Encoded)]，只有未命中缓存的角色才会执行换脸
+    """
+    output = output or OutputOptions()
+    if source_is_base64:
+        with metrics.stage('base64_decode'):
+            source_image = base64.b64decode(source_image.split('base64,')[1])
+    upload_key = content_key(source_image)
+    keys = [result_key(upload_key, result_signature(gender, role, faces, output)) for role in roles]
+    results = {key: cached_result(key, output.preview_side > 0) for key in set(keys)}
+    missing = list(dict.fromkeys(role for role, key in zip(roles, keys) if results[key] is None))
+    if missing:
+        for role, encoded in zip(missing, run_swap(source_image, gender, missing, faces=faces, output=output)):
+            key = keys[roles.index(role)]
+            results[key] = encoded
+            result_cache.put(key, encoded.data)
+            if encoded.preview is not None:
+                result_cache.put(preview_key(key), encoded.preview)
+    return [(key, results[key]) for key in keys]
+
+def data_url(data):
+    return f'data:{sniff_mimetype(data)};base64,' + base64.b64encode(data).decode('utf-8')
+
+def result_response(key, result):
+    """返回结果图片，ETag 为结果哈希，客户端带 If-None-Match 时返回 304"""
+    response = Response(result, mimetype=sniff_mimetype(result))
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.RESULT_CACHE_MAX_AGE
+    if key in result_cache:
+        response.headers['Content-Location'] = url_for('get_result', key=key)
+    return response.make_conditional(request)
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f'上传的文件不能超过 {config.UPLOAD_MAX_MB}MB'}), 413
 
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, upload_script=UPLOAD_SCRIPT)
+
+@app.route('/live')
+def live_page():
+    if sock is None:
+        return jsonify({'error': '未安装 flask-sock，实时换脸不可用'}), 404
+    return render_template_string(LIVE_TEMPLATE, fps=config.LIVE_TARGET_FPS, upload_script=UPLOAD_SCRIPT)
+
+if sock is not None:
+    @sock.route('/live/ws')
+    def live_ws(ws):
+        """实时换脸 WebSocket，协议见 live.LiveSession"""
+        live.serve(ws)
 
 @app.route('/api/roles', methods=['GET'])
 def get_roles():
-    """获取所有角色信息的API"""
+    """获取所有角色信息的API，每个角色带 thumbnail 和 srcset（缩略图）"""
     try:
-        return jsonify(ROLES)
+        return jsonify(role_thumbnails.describe(catalog.roles))
     except Exception as e:
-        print(f"Error in get_roles route: {str(e)}")
+        logger.error("获取角色失败", extra={'error': str(e)})
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/upload-limits', methods=['GET'])
+def get_upload_limits():
+    """浏览器上传前预处理的参数：长边上限、重新压缩的格式和质量，以及服务器接受的格式和大小"""
+    response = jsonify({
+        'max_side': config.CLIENT_UPLOAD_MAX_SIDE,
+        'format': config.CLIENT_UPLOAD_FORMAT,
+        'quality': config.CLIENT_UPLOAD_QUALITY,
+        'types': ['image/jpeg', 'image/png', 'image/webp', 'image/bmp'],
+        'max_bytes': config.UPLOAD_MAX_MB * 1024 * 1024
+    })
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
+@app.route('/roles/thumbs/<name>', methods=['GET'])
+def get_role_thumbnail(name):
+    """角色缩略图，文件名带版本号，可以长期缓存"""
+    response = send_from_directory(role_thumbnails.cache_dir, name, max_age=config.ROLE_THUMB_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def read_upload():
+    """解析换脸请求中的上传图片和参数
+
+    支持三种请求格式：
+    1. multipart/form-data：image 字段为图片文件，其余参数为表单字段
+    2. 原始图片（Content-Type: image/*）：请求体为图片，参数放在查询字符串中
+    3. JSON：{"image": <base64 data URL>, ...}（兼容旧版前端）
+    返回 (图片, 是否为 base64, 参数, 是否返回二进制结果)
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        if upload is None:
+            raise KeyError('image')
+        params = request.form.to_dict(flat=False)
+        return upload.read(), False, params, True
+    if request.mimetype.startswith('image/'):
+        params = request.args.to_dict(flat=False)
+        return request.get_data(), False, params, True
+
+    data = request.json
+    params = {key: value if isinstance(value, list) else [value]
+              for key, value in data.items() if key != 'image'}
+    return data['image'], True, params, False
+
+def wants_binary(binary_upload, mimetype='image/jpeg'):
+    """二进制上传默认返回二进制图片，Accept 头明确偏好其中一种格式时以 Accept 为准"""
+    accept = request.accept_mimetypes
+    if accept[mimetype] != accept['application/json']:
+        return accept[mimetype] > accept['application/json']
+    return binary_upload
+
+def read_output(params):
+    """输出参数：format（jpeg / webp / png）、quality、max_bytes（目标大小）、max_side（最大边长）、
+    preview（true 或预览图长边）；无效时返回 (None, 错误信息)"""
+    try:
+        return OutputOptions.from_params(params), None
+    except Exception as e:
+        return None, str(e)
+
+def read_faces(params):
+    """多人换脸参数 faces：position（按位置）/ similarity（按相似度）/ "0:1,1:0"（按从左到右的序号），
+    省略时只换第一个人脸；无效时返回 (None, 错误信息)"""
+    value = params.get('faces', [''])[0]
+    if not value:
+        return None, None
+    try:
+        return parse_face_mapping(value), None
+    except Exception as e:
+        return None, str(e)
+
 @app.route('/swap', methods=['POST'])
 def swap():
     try:
-        data = request.json
-        source_image = data['image']
-        gender = data['gender']
-        role = data['role']
+        source_image, source_is_base64, params, binary_upload = read_upload()
+        gender = params['gender'][0]
+        role = params['role'][0]
+        faces, error = read_faces(params)
+        output, output_error = read_output(params)
         
-        if gender not in ROLES or role not in ROLES[gender]:
+        if role not in catalog.roles.get(gender, {}):
             return jsonify({'error': '无效的角色选择'}), 400
+        if error is not None or output_error is not None:
+            return jsonify({'error': error or output_error}), 400
         
-        target_path = os.path.join(os.path.dirname(__file__), ROLES[gender][role]['path'].lstrip('/'))
+        key, result = swap_cached(
+            source_image,
+            gender,
+            [role],
+            source_is_base64=source_is_base64,
+            faces=faces,
+            output=output
+        )[0]
+
+        if wants_binary(binary_upload, output.mimetype):
+            response = result_response(key, result.data)
+            if result.preview is not None and preview_key(key) in result_cache:
+                response.headers['X-Preview-Location'] = url_for('get_result', key=preview_key(key))
+            return response
+
+        info = {
+            'success': True,
+            'image': data_url(result.data)
+        }
+        if result.preview is not None:
+            info['preview'] = data_url(result.preview)
+        if key in result_cache:
+            info['url'] = url_for('get_result', key=key)
+        if result.preview is not None and preview_key(key) in result_cache:
+            info['preview_url'] = url_for('get_result', key=preview_key(key))
+        return jsonify(info)
         
-        result_base64 = swap_face(
+    except ImageRejected as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("换脸请求失败", extra={'error': str(e)})
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/swap/batch', methods=['POST'])
+def swap_batch():
+    """一次上传换多个角色
+
+    请求体：{"image": ..., "gender": "male", "roles": ["soldier", "doctor"]}，
+    roles 省略或为 "all" 时换该性别下的全部角色；也可以用 multipart/form-data 上传，
+    roles 字段重复出现表示多个角色。
+    返回：{"success": true, "images": {"soldier": "data:image/jpeg;base64,...", ...},
+           "urls": {"soldier": "/results/<hash>", ...}}（开启结果缓存时才有 urls）
+    输出参数与 /swap 相同，要求预览图时另有 previews（和 preview_urls）。
+    """
+    try:
+        source_image, source_is_base64, params, _ = read_upload()
+        gender = params['gender'][0]
+        roles = params.get('roles', ['all'])
+        faces, error = read_faces(params)
+        output, output_error = read_output(params)
+
+        gender_roles = catalog.roles.get(gender)
+        if gender_roles is None:
+            return jsonify({'error': '无效的角色选择'}), 400
+        if error is not None or output_error is not None:
+            return jsonify({'error': error or output_error}), 400
+        if roles == ['all']:
+            roles = list(gender_roles)
+        if not roles or any(role not in gender_roles for role in roles):
+            return jsonify({'error': '无效的角色选择'}), 400
+
+        results = swap_cached(
             source_image,
-            target_path,
-            source_is_base64=True
+            gender,
+            roles,
+            source_is_base64=source_is_base64,
+            faces=faces,
+            output=output
         )
-        
-        return jsonify({
+
+        info = {
             'success': True,
-            'image': f'data:image/jpeg;base64,{result_base64}'
-        })
-        
+            'images': {role: data_url(result.data) for role, (_, result) in zip(roles, results)}
+        }
+        if output.preview_side:
+            info['previews'] = {role: data_url(result.preview) for role, (_, result) in zip(roles, results)}
+        if result_cache.enabled:
+            info['urls'] = {role: url_for('get_result', key=key)
+                            for role, (key, _) in zip(roles, results) if key in result_cache}
+            if output.preview_side:
+                info['preview_urls'] = {role: url_for('get_result', key=preview_key(key))
+                                        for role, (key, _) in zip(roles, results)
+                                        if preview_key(key) in result_cache}
+        return jsonify(info)
+
+    except ImageRejected as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("批量换脸请求失败", extra={'error': str(e)})
+        return jsonify({'error': str(e)}), 500
+
+def run_swap_one(source_image, gender, role, source_is_base64=False, faces=None, output=None):
+    return swap_cached(source_image, gender, [role], source_is_base64, faces, output)[0][1].data
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文本格式的监控指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/results/<key>', methods=['GET'])
+def get_result(key):
+    """按结果哈希获取缓存的换脸结果，支持 ETag / If-None-Match"""
+    if not KEY_PATTERN.match(key):
+        return jsonify({'error': '结果不存在或已过期'}), 404
+    result = result_cache.get(key)
+    if result is None:
+        return jsonify({'error': '结果不存在或已过期'}), 404
+    return result_response(key, result)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """提交异步换脸任务，请求格式与 /swap 相同
+
+    返回 202 和任务 id；队列已满时返回 429，Retry-After 头为建议的重试秒数
+    """
+    try:
+        source_image, source_is_base64, params, _ = read_upload()
+        gender = params['gender'][0]
+        role = params['role'][0]
+        faces, error = read_faces(params)
+        output, output_error = read_output(params)
+
+        if role not in catalog.roles.get(gender, {}):
+            return jsonify({'error': '无效的角色选择'}), 400
+        if error is not None or output_error is not None:
+            return jsonify({'error': error or output_error}), 400
+
+        job = job_queue.submit(run_swap_one, source_image, gender, role,
+                               source_is_base64=source_is_base64, faces=faces, output=output)
+
+        info = job.to_dict()
+        info['status_url'] = url_for('get_job', job_id=job.id)
+        info['events_url'] = url_for('job_events', job_id=job.id)
+        info['queue_depth'] = job_queue.depth
+        return jsonify(info), 202, {'Location': info['status_url']}
+
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
     except Exception as e:
-        print(f"Error in swap route: {str(e)}")
+        logger.error("提交任务失败", extra={'error': str(e)})
         return jsonify({'error': str(e)}), 500
 
+def run_video_job(source_image, gender, role, source_is_base64=False):
+    """视频换脸任务，结果视频保存在 VIDEO_OUTPUT_DIR 中，任务过期时删除"""
+    if source_is_base64:
+        source_image = base64.b64decode(source_image.split('base64,')[1])
+    os.makedirs(config.VIDEO_OUTPUT_DIR, exist_ok=True)
+    output_path = os.path.join(config.VIDEO_OUTPUT_DIR, uuid.uuid4().hex + '.mp4')
+    video_path = video_catalog.path(gender, role)
+    result = FileResult(output_path, 'video/mp4')
+    try:
+        with SWAPS_IN_FLIGHT.track():
+            swap_video(source_image, video_path, output_path, progress=report_progress)
+    except Exception:
+        result.remove()
+        raise
+    return result
+
+@app.route('/api/videos', methods=['GET'])
+def get_videos():
+    """获取所有角色视频信息的API"""
+    return jsonify(video_catalog.roles)
+
+@app.route('/jobs/video', methods=['POST'])
+def create_video_job():
+    """提交视频换脸任务，请求格式与 /jobs 相同，role 为角色视频目录（static/videos）中的角色
+
+    视频任务耗时较长，状态中带有 progress（0~1）；完成后 result_url 返回 mp4 视频
+    """
+    try:
+        source_image, source_is_base64, params, _ = read_upload()
+        gender = params['gender'][0]
+        role = params['role'][0]
+
+        if role not in video_catalog.roles.get(gender, {}):
+            return jsonify({'error': '无效的角色选择'}), 400
+
+        job = job_queue.submit(run_video_job, source_image, gender, role,
+                               source_is_base64=source_is_base64)
+
+        info = job.to_dict()
+        info['status_url'] = url_for('get_job', job_id=job.id)
+        info['events_url'] = url_for('job_events', job_id=job.id)
+        info['queue_depth'] = job_queue.depth
+        return jsonify(info), 202, {'Location': info['status_url']}
+
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        logger.error("提交视频任务失败", extra={'error': str(e)})
+        return jsonify({'error': str(e)}), 500
+
+def job_info(job):
+    info = job.to_dict()
+    if job.status == 'done':
+        info['result_url'] = url_for('get_job_result', job_id=job.id)
+    elif job.status == 'queued':
+        info['queue_depth'] = job_queue.depth
+    return info
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询任务状态，完成后返回 result_url"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(job_info(job))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """获取任务结果图片或视频"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    if job.status != 'done':
+        return jsonify(job_info(job)), 409
+    if isinstance(job.result, FileResult):
+        return send_file(job.result.path, mimetype=job.result.mimetype, conditional=True)
+    return Response(job.result, mimetype=sniff_mimetype(job.result))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """以 server-sent events 推送任务状态，任务结束后关闭连接"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+
+    def stream():
+        last = None
+        while True:
+            info = job_info(job)
+            if info != last:
+                yield f"data: {json.dumps(info, ensure_ascii=False)}\n\n"
+                last = info
+            if job.finished:
+                return
+            job.wait(timeout=15)
+            if job_info(job) == last:
+                # 心跳，避免代理断开空闲连接
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
+    setup_logging()
+    if sock is None:
+        logger.warning("未安装 flask-sock，实时换脸（/live）不可用", extra={'requirement': 'flask-sock'})
+    # 启动前生成缺少的角色缩略图
+    role_thumbnails.prepare()
+    if worker_pool is not None:
+        # 工作进程各自加载模型，前端进程不加载；要在启动其他线程之前创建子进程
+        worker_pool.start()
+    else:
+        # 启动时加载模型并建立角色索引，避免第一个请求等待
+        warm_up()
+    job_queue.start()
     app.run(host="0.0.0.0", port=1204) 
\ No newline at end of file
@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """动态微批处理
+
+    多个线程同时调用 submit() 时，把 window_ms 毫秒内到达的请求（最多 max_batch_size 个）
+    合并成一次 run_batch(items) 调用，再把结果按顺序分发回各个调用方。
+    单个请求最多额外等待 window_ms 毫秒。run_batch 必须返回与 items 等长的结果列表。
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, window_ms=10, name='batcher'):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, item):
+        """提交单个请求并等待结果"""
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        """提交多个请求（可能被拆到不同的 batch 中），按顺序返回结果"""
+        futures = [Future() for _ in items]
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                raise Exception(f"{self.name} 已关闭")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+            self._pending.extend((now, item, future) for item, future in zip(items, futures))
+            self._cond.notify()
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    @property
+    def avg_batch_size(self):
+        return self.items / self.batches if self.batches else 0.0
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # 从最早到达的请求开始计时，凑满 batch 或等待超时后执行
+                deadline = self._pending[0][0] + self.window
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+
+            futures = [future for _, _, future in batch]
+            try:
+                results = self.run_batch([item for _, item, _ in batch])
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,370 @@
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import onnxruntime
+from insightface.utils import face_align
+
+import config
+import pipeline
+from engine import FaceSwapEngine, detection_proxy, get_engine
+from model_tools import calibration_images
+
+DEFAULT_SOURCE = 'static/roles/male/teacher.jpg'
+DEFAULT_TARGET = 'static/roles/male/soldier.jpg'
+DEFAULT_IMAGES = 'static/roles'
+
+
+def measure(func, repeat):
+    """重复执行 func，返回每次的 (CPU 时间, 墙钟时间)，单位毫秒"""
+    func()  # 预热
+    cpu_times, wall_times = [], []
+    for _ in range(repeat):
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        func()
+        cpu_times.append((time.process_time() - cpu_start) * 1000)
+        wall_times.append((time.perf_counter() - wall_start) * 1000)
+    return np.array(cpu_times), np.array(wall_times)
+
+
+def bench_profiles(args):
+    """对比全部模块与按场景裁剪模块时，一次换脸请求中人脸分析的 CPU 时间"""
+    source = cv2.imread(args.source)
+    target = cv2.imread(args.target)
+    if source is None or target is None:
+        raise Exception("无法加载测试图片")
+
+    engines = {
+        'full (buffalo_l 全部模块)': FaceSwapEngine(profiles={'source': None, 'target': None}),
+        'pruned (按场景裁剪)': FaceSwapEngine(),
+    }
+    for name, engine in engines.items():
+        with engine:
+            def analyse():
+                engine.detect(source, profile='source')
+                engine.detect(target, profile='target')
+            cpu, wall = measure(analyse, args.repeat)
+        print(f"{name}: CPU {cpu.mean():.1f} ms/请求 (p50 {np.median(cpu):.1f}), "
+              f"墙钟 {wall.mean():.1f} ms/请求")
+
+
+def summarize(cpu, wall):
+    """把 measure() 的结果汇总成可写入 JSON 的统计值（毫秒）"""
+    return {'mean_ms': round(float(wall.mean()), 3),
+            'p50_ms': round(float(np.median(wall)), 3),
+            'p95_ms': round(float(np.percentile(wall, 95)), 3),
+            'cpu_ms': round(float(cpu.mean()), 3)}
+
+
+def bench_stages(args):
+    """分阶段测量一次换脸请求的耗时、内存和不同并发下的吞吐量
+
+    各阶段与 pipeline.swap_faces 的实际流程一致，单独重复执行 args.repeat 次；
+    端到端测试每次都清空源人脸缓存，角色图片按路径读取，不使用角色索引。
+    """
+    with open(args.source, 'rb') as f:
+        source_bytes = f.read()
+    data_url = 'data:image/jpeg;base64,' + base64.b64encode(source_bytes).decode('utf-8')
+    target = cv2.imread(args.target)
+    if target is None:
+        raise Exception("无法加载测试图片")
+
+    engine = get_engine()
+    det_model = engine.analyser.det_model
+    rec_model = engine.analyser.models['recognition']
+    swapper = engine.swapper
+
+    # 准备各阶段的输入
+    source = pipeline.decode_image(source_bytes)
+    source_proxy, _ = detection_proxy(source, config.DET_PROXY_SIZE)
+    target_proxy, _ = detection_proxy(target, config.DET_PROXY_SIZE)
+    source_faces = engine.detect(source, profile='source', adjust=pipeline.SOURCE_ADJUST)
+    target_faces = engine.detect(target, profile='target')
+    if not source_faces or not target_faces:
+        raise Exception("测试图片中没有检测到人脸")
+    latent = engine.source_latent(source_faces[0])
+    template = engine.paste_template(target, target_faces[0], pipeline.RESULT_ADJUST)
+    bgr_fake = _swap_output(swapper, template.blob, latent)
+    result = template.apply(bgr_fake)
+    alpha, beta = pipeline.SOURCE_ADJUST
+
+    def align_and_embed():
+        crop = face_align.norm_crop(source, landmark=source_faces[0].kps,
+                                    image_size=rec_model.input_size[0])
+        return rec_model.get_feat([crop])
+
+    def end_to_end():
+        pipeline.source_cache.clear()
+        return pipeline.swap_faces(source_bytes, [args.target])
+
+    stages = {
+        'base64_decode': lambda: base64.b64decode(data_url.split('base64,')[1]),
+        'imdecode': lambda: pipeline.decode_image(source_bytes),
+        'resize': lambda: detection_proxy(source, config.DET_PROXY_SIZE),
+        'convert_scale_abs': lambda: cv2.convertScaleAbs(source_proxy, alpha=alpha, beta=beta),
+        'source_detection': lambda: det_model.detect(source_proxy, max_num=0, metric='default'),
+        'target_detection': lambda: det_model.detect(target_proxy, max_num=0, metric='default'),
+        'recognition': align_and_embed,
+        'inswapper': lambda: _swap_output(swapper, template.blob, latent),
+        'paste_back': lambda: template.apply(bgr_fake),
+        'jpeg_encode': lambda: cv2.imencode('.jpg', result,
+                                            [int(cv2.IMWRITE_JPEG_QUALITY), pipeline.JPEG_QUALITY]),
+        'end_to_end': end_to_end,
+    }
+    results = {'meta': _bench_meta(args), 'stages': {}}
+    for name, func in stages.items():
+        results['stages'][name] = summarize(*measure(func, args.repeat))
+        print(f"{name:>18}: {results['stages'][name]['p50_ms']:8.2f} ms (p50)")
+
+    # 内存：Python 侧（含 numpy）的分配由 tracemalloc 统计，onnxruntime 内部的分配只体现在 RSS 中
+    tracemalloc.start()
+    end_to_end()
+    current, peak = tracemalloc.get_traced_memory()
+    allocations = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    results['memory'] = {
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'traced_peak_mb': round(peak / 1024 / 1024, 2),
+        'traced_retained_mb': round(current / 1024 / 1024, 2),
+        'retained_blocks': allocations,
+    }
+    print(f"内存: {results['memory']}")
+
+    results['throughput'] = {}
+    for concurrency in args.concurrency:
+        latencies = []
+
+        def timed():
+            start = time.perf_counter()
+            end_to_end()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for future in [executor.submit(timed) for _ in range(args.requests)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        latencies = np.array(latencies)
+        results['throughput'][str(concurrency)] = {
+            'requests_per_second': round(args.requests / elapsed, 3),
+            'p50_ms': round(float(np.median(latencies)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        }
+        print(f"并发 {concurrency}: {results['throughput'][str(concurrency)]}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+def _bench_meta(args):
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'onnxruntime': onnxruntime.__version__,
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'machine': platform.machine(),
+        'source': args.source,
+        'target': args.target,
+        'repeat': args.repeat,
+    }
+
+
+def compare_results(current, baseline, threshold=0.1):
+    """对比两次测试结果，打印差异，返回变慢超过 threshold（比例）的项目列表"""
+    regressions = []
+
+    def check(name, now, before, higher_is_better=False):
+        if not before:
+            return
+        change = (now - before) / before
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            flag = '  <-- 变慢'
+            regressions.append(name)
+        print(f"{name:>28}: {before:10.2f} -> {now:10.2f} ({change:+.1%}){flag}")
+
+    for name, stats in current.get('stages', {}).items():
+        if name in baseline.get('stages', {}):
+            check(f'{name} p50_ms', stats['p50_ms'], baseline['stages'][name]['p50_ms'])
+    if 'memory' in current and 'memory' in baseline:
+        check('peak_rss_mb', current['memory']['peak_rss_mb'], baseline['memory']['peak_rss_mb'])
+    for concurrency, stats in current.get('throughput', {}).items():
+        if concurrency in baseline.get('throughput', {}):
+            check(f'并发 {concurrency} requests_per_second', stats['requests_per_second'],
+                  baseline['throughput'][concurrency]['requests_per_second'], higher_is_better=True)
+    if regressions:
+        print(f"超过 {threshold:.0%} 的退化: {', '.join(regressions)}")
+    return regressions
+
+
+def bench_compare(args):
+    """对比两个已保存的测试结果文件"""
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if compare_results(current, baseline, args.threshold):
+        sys.exit(1)
+
+
+def ssim(a, b):
+    """两张 BGR 图片灰度图的结构相似度（11x11 高斯窗口，与常用 SSIM 定义一致）"""
+    a = cv2.cvtColor(a, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    def blur(x):
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / \
+        ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def _iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _swap_output(swapper, blob, latent):
+    pred = swapper.session.run(swapper.output_names,
+                               {swapper.input_names[0]: blob, swapper.input_names[1]: latent})[0]
+    return np.clip(255 * pred[0].transpose((1, 2, 0)), 0, 255).astype(np.uint8)[:, :, ::-1]
+
+
+def bench_quantized(args):
+    """对比 INT8 量化模型与 FP32 模型的输出误差和推理速度
+
+    每个模型单独比较：输入都由 FP32 模型生成，只替换被比较的模型。
+    检测：按 IoU 匹配人脸后的关键点平均误差（像素，检测缩小图坐标）和漏检数；
+    识别：同一对齐人脸的特征向量余弦相似度；换脸：128x128 输出图的 SSIM。
+    """
+    images = [img for _, img in calibration_images(args.images, args.limit)]
+    if not images:
+        raise Exception(f"没有可用的测试图片: {args.images}")
+    models = args.models.split(',') if args.models != 'all' else 'all'
+    profiles = {'source': ['detection', 'recognition']}
+    fp32 = FaceSwapEngine(quantized_models=[], batch_window_ms=0, profiles=profiles).load()
+    int8 = FaceSwapEngine(quantized_models=models, batch_window_ms=0, profiles=profiles).load()
+
+    faces = [(img, face) for img in images for face in fp32.detect(img, profile='source')]
+    if not faces:
+        raise Exception("测试图片中没有检测到人脸")
+
+    # 检测
+    det32, det8 = fp32.analyser.det_model, int8.analyser.det_model
+    proxies = [detection_proxy(img, config.DET_PROXY_SIZE)[0] for img in images]
+    kps_errors, missed = [], 0
+    for proxy in proxies:
+        bboxes32, kpss32 = det32.detect(proxy, max_num=0, metric='default')
+        bboxes8, kpss8 = det8.detect(proxy, max_num=0, metric='default')
+        for bbox, kps in zip(bboxes32, kpss32):
+            ious = [_iou(bbox, other) for other in bboxes8]
+            if not ious or max(ious) < 0.5:
+                missed += 1
+                continue
+            kps_errors.append(np.linalg.norm(kps - kpss8[int(np.argmax(ious))], axis=1).mean())
+    report('detection', int8, det8,
+           f"关键点误差 {np.mean(kps_errors) if kps_errors else 0:.2f}px，漏检 {missed}",
+           lambda: det32.detect(proxies[0], max_num=0, metric='default'),
+           lambda: det8.detect(proxies[0], max_num=0, metric='default'), args.repeat)
+
+    # 识别
+    rec32, rec8 = fp32.analyser.models['recognition'], int8.analyser.models['recognition']
+    crops = [face_align.norm_crop(img, landmark=face.kps, image_size=rec32.input_size[0])
+             for img, face in faces]
+    emb32, emb8 = rec32.get_feat(crops), rec8.get_feat(crops)
+    cosine = np.sum(emb32 * emb8, axis=1) / \
+        (np.linalg.norm(emb32, axis=1) * np.linalg.norm(emb8, axis=1))
+    report('recognition', int8, rec8,
+           f"特征余弦相似度 平均 {cosine.mean():.4f}，最低 {cosine.min():.4f}",
+           lambda: rec32.get_feat(crops[:1]), lambda: rec8.get_feat(crops[:1]), args.repeat)
+
+    # 换脸
+    swap32, swap8 = fp32.swapper, int8.swapper
+    scores = []
+    for i, (img, face) in enumerate(faces):
+        latent = fp32.source_latent(faces[(i + 1) % len(faces)][1])
+        blob = fp32.paste_template(img, face).blob
+        scores.append(ssim(_swap_output(swap32, blob, latent), _swap_output(swap8, blob, latent)))
+    blob = fp32.paste_template(*faces[0]).blob
+    latent = fp32.source_latent(faces[0][1])
+    report('swapper', int8, swap8,
+           f"输出 SSIM 平均 {np.mean(scores):.4f}，最低 {np.min(scores):.4f}",
+           lambda: _swap_output(swap32, blob, latent), lambda: _swap_output(swap8, blob, latent),
+           args.repeat)
+
+
+def report(name, engine, model, accuracy, run_fp32, run_int8, repeat):
+    if engine._quantized_path(model.model_file) is None:
+        print(f"{name}: 未找到量化模型，跳过")
+        return
+    _, wall32 = measure(run_fp32, repeat)
+    _, wall8 = measure(run_int8, repeat)
+    print(f"{name}: {accuracy}；FP32 {wall32.mean():.1f} ms，INT8 {wall8.mean():.1f} ms，"
+          f"加速 {wall32.mean() / wall8.mean():.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='换脸流程性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    profiles = subparsers.add_parser('profiles', help='对比人脸分析模块裁剪前后的 CPU 时间')
+    profiles.add_argument('--source', default=DEFAULT_SOURCE)
+    profiles.add_argument('--target', default=DEFAULT_TARGET)
+    profiles.add_argument('--repeat', type=int, default=20)
+    profiles.set_defaults(func=bench_profiles)
+
+    quantized = subparsers.add_parser('quantized', help='对比 INT8 量化模型与 FP32 模型的误差和速度')
+    quantized.add_argument('--images', default=DEFAULT_IMAGES, help='测试图片目录')
+    quantized.add_argument('--limit', type=int, default=32)
+    quantized.add_argument('--models', default='all',
+                           help='要对比的量化模型文件名（不含扩展名），逗号分隔，默认全部')
+    quantized.add_argument('--repeat', type=int, default=20)
+    quantized.set_defaults(func=bench_quantized)
+
+    stages = subparsers.add_parser('stages', help='分阶段测量换脸流程的耗时、内存和吞吐量')
+    stages.add_argument('--source', default=DEFAULT_SOURCE)
+    stages.add_argument('--target', default=DEFAULT_TARGET)
+    stages.add_argument('--repeat', type=int, default=20)
+    stages.add_argument('--concurrency', type=lambda value: [int(v) for v in value.split(',')],
+                        default=[1, 2, 4], help='逗号分隔的并发数，如 1,2,4')
+    stages.add_argument('--requests', type=int, default=16, help='每个并发级别的请求数')
+    stages.add_argument('--output', help='保存结果的 JSON 文件')
+    stages.add_argument('--baseline', help='与之对比的基线 JSON 文件，有退化时以状态码 1 退出')
+    stages.add_argument('--threshold', type=float, default=0.1, help='判定退化的比例')
+    stages.set_defaults(func=bench_stages)
+
+    compare = subparsers.add_parser('compare', help='对比两个已保存的测试结果')
+    compare.add_argument('current')
+    compare.add_argument('baseline')
+    compare.add_argument('--threshold', type=float, default=0.1)
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
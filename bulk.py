@@ -0,0 +1,278 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+
+import config
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+# 清单文件中一行一个图片路径（.txt）或第一列为图片路径（.csv）
+LIST_EXTENSIONS = ('.txt', '.csv')
+
+# 工作进程内的引擎，由 _init_worker 创建
+_engine = None
+
+
+def expand_inputs(specs):
+    """把目录、glob 或清单文件展开成图片路径列表（去重，保持顺序）"""
+    paths = []
+    for spec in specs:
+        if os.path.isdir(spec):
+            found = sorted(p for p in glob.glob(os.path.join(spec, '**', '*'), recursive=True)
+                           if p.lower().endswith(IMAGE_EXTENSIONS))
+        elif spec.lower().endswith(LIST_EXTENSIONS) and os.path.isfile(spec):
+            with open(spec, newline='', encoding='utf-8') as f:
+                found = [row[0].strip() for row in csv.reader(f) if row and row[0].strip()
+                         and not row[0].startswith('#')]
+        else:
+            found = sorted(glob.glob(spec, recursive=True))
+        if not found:
+            logger.warning("没有找到图片", extra={'input': spec})
+        paths.extend(found)
+    return list(dict.fromkeys(paths))
+
+
+def read_pairs(path):
+    """读取 source,target 配对清单（CSV，不含表头），返回 [(源图片, 目标图片)]"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return [(row[0].strip(), row[1].strip()) for row in csv.reader(f)
+                if len(row) >= 2 and not row[0].startswith('#')]
+
+
+def output_names(paths):
+    """为每个路径生成输出用的名字：默认用文件名，文件名重复时加上路径哈希"""
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    counts = {}
+    for stem in stems:
+        counts[stem] = counts.get(stem, 0) + 1
+    return {path: stem if counts[stem] == 1 else f'{stem}-{hashlib.sha1(path.encode("utf-8")).hexdigest()[:8]}'
+            for path, stem in zip(paths, stems)}
+
+
+class Manifest:
+    """可续跑的运行清单（JSON Lines），每完成一对写一行
+
+    中断后用同一个清单重新运行时，已经成功的配对直接跳过；retry_failed=True 时失败的配对也重新执行。
+    """
+
+    def __init__(self, path, retry_failed=False):
+        self.path = path
+        self.finished = set()
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 上次中断时写了一半的行
+                        continue
+                    if entry['status'] == 'done' or not retry_failed:
+                        self.finished.add((entry['source'], entry['target']))
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, pair):
+        return pair in self.finished
+
+    def record(self, source, target, output, error=None):
+        entry = {'source': source, 'target': target, 'output': output,
+                 'status': 'done' if error is None else 'failed'}
+        if error is not None:
+            entry['error'] = error
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.finished.add((source, target))
+
+    def close(self):
+        self._file.close()
+
+
+def _init_worker(engine_kwargs):
+    """工作进程初始化：每个进程只加载一次模型"""
+    global _engine
+    from engine import get_engine
+    from logs import setup_logging
+
+    setup_logging()
+    _engine = get_engine(**engine_kwargs)
+
+
+def _read_image(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise Exception(f"无法加载图片: {path}")
+    return img
+
+
+def _source_latent(path):
+    """检测源图片中的人脸并计算 latent，返回 (路径, latent, 错误信息)"""
+    from pipeline import SOURCE_ADJUST
+
+    try:
+        faces = _engine.detect(_read_image(path), profile='source', adjust=SOURCE_ADJUST)
+        if not faces:
+            raise Exception("未在源图片中检测到人脸")
+        return path, _engine.source_latent(faces[0]), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def _target_kps(path):
+    """检测目标图片中的人脸，返回 (路径, 关键点, 错误信息)"""
+    try:
+        faces = _engine.detect(_read_image(path), profile='target')
+        if not faces:
+            raise Exception("未在目标图片中检测到人脸")
+        return path, faces[0].kps, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def _swap_target(task):
+    """把多个源人脸换到同一张目标图片上：目标图片只读取一次，贴回模板复用
+
+    task 为 (目标路径, 关键点, [(源路径, latent, 输出路径)])，返回 [(源路径, 目标路径, 输出路径, 错误信息)]
+    """
+    from insightface.app.common import Face
+    from pipeline import JPEG_QUALITY, RESULT_ADJUST
+
+    target, kps, jobs = task
+    try:
+        template = _engine.paste_template(_read_image(target), Face(kps=kps), RESULT_ADJUST)
+    except Exception as e:
+        return [(source, target, output, str(e)) for source, _, output in jobs]
+    results = []
+    for source, latent, output in jobs:
+        try:
+            result = _engine.generate_batch([template], latent)[0]
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+            # 先写临时文件再改名，中断时不会留下写了一半的图片
+            tmp_path = f'{output}.{os.getpid()}.tmp.jpg'
+            if not cv2.imwrite(tmp_path, result, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]):
+                raise Exception("图片编码失败")
+            os.replace(tmp_path, output)
+            results.append((source, target, output, None))
+        except Exception as e:
+            results.append((source, target, output, str(e)))
+    return results
+
+
+def run(pairs, output_dir, manifest, workers=None, onnx_threads=0, engine_kwargs=None, chunk_size=32):
+    """执行批量换脸，返回 (成功数, 失败数)
+
+    先在进程池中计算所有源图片的 latent 和所有目标图片的人脸关键点（每张图片只检测一次），
+    再按目标图片分组换脸，工作进程直接把结果写到 output_dir/<源图片名>/<目标图片名>.jpg，
+    每完成一组就写入清单。
+    """
+    workers = workers or os.cpu_count() or 1
+    engine_kwargs = dict(engine_kwargs or {})
+    engine_kwargs.setdefault('intra_op_threads', onnx_threads or max(1, (os.cpu_count() or 1) // workers))
+    source_names = output_names(list(dict.fromkeys(source for source, _ in pairs)))
+    target_names = output_names(list(dict.fromkeys(target for _, target in pairs)))
+    outputs = {(source, target): os.path.join(output_dir, source_names[source], target_names[target] + '.jpg')
+               for source, target in pairs}
+
+    pending = [pair for pair in pairs if pair not in manifest]
+    skipped = len(pairs) - len(pending)
+    if skipped:
+        logger.info("清单中已完成的配对，跳过", extra={'skipped': skipped})
+    if not pending:
+        return 0, 0
+
+    done = failed = 0
+    start = time.perf_counter()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(engine_kwargs,)) as pool:
+        sources = list(dict.fromkeys(source for source, _ in pending))
+        targets = list(dict.fromkeys(target for _, target in pending))
+        latents, kpss, errors = {}, {}, {}
+        for path, latent, error in pool.imap_unordered(_source_latent, sources, chunksize=4):
+            latents[path] = latent
+            errors[path] = error
+        for path, kps, error in pool.imap_unordered(_target_kps, targets, chunksize=4):
+            kpss[path] = kps
+            errors[path] = error
+        logger.info("人脸检测完成", extra={'sources': len(sources), 'targets': len(targets),
+                                        'seconds': round(time.perf_counter() - start, 1)})
+
+        # 检测失败的图片所在的配对直接记为失败
+        groups = {}
+        for source, target in pending:
+            error = errors[source] or errors[target]
+            if error is not None:
+                manifest.record(source, target, None, error)
+                failed += 1
+                continue
+            groups.setdefault(target, []).append((source, latents[source], outputs[(source, target)]))
+        tasks = [(target, kpss[target], jobs[i:i + chunk_size])
+                 for target, jobs in groups.items() for i in range(0, len(jobs), chunk_size)]
+
+        for results in pool.imap_unordered(_swap_target, tasks):
+            for source, target, output, error in results:
+                manifest.record(source, target, output if error is None else None, error)
+                if error is None:
+                    done += 1
+                else:
+                    failed += 1
+            finished = done + failed
+            if finished % 100 < len(results):
+                seconds = time.perf_counter() - start
+                logger.info("批量换脸进度", extra={'finished': finished, 'total': len(pending),
+                                                 'done': done, 'failed': failed,
+                                                 'pairs_per_second': round(finished / seconds, 1)})
+    return done, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='批量换脸：源图片和目标图片可以是目录、glob 或清单文件（.txt/.csv），默认换全部组合')
+    parser.add_argument('--sources', nargs='+', help='源人脸图片')
+    parser.add_argument('--targets', nargs='+', help='目标图片')
+    parser.add_argument('--pairs', help='只换指定配对：CSV 文件，每行 source,target')
+    parser.add_argument('--output', required=True, help='输出目录')
+    parser.add_argument('--manifest', help='运行清单（默认 <输出目录>/manifest.jsonl），中断后重新运行时跳过已完成的配对')
+    parser.add_argument('--retry-failed', action='store_true', help='续跑时重新执行清单中失败的配对')
+    parser.add_argument('--workers', type=int, default=0, help='工作进程数，默认 CPU 核数')
+    parser.add_argument('--onnx-threads', type=int, default=0, help='每个进程的 onnxruntime 线程数，默认 CPU 核数 / 进程数')
+    parser.add_argument('--model-dir', default=config.MODEL_DIR, help='模型目录')
+    parser.add_argument('--swapper', help='换脸模型路径，默认 <模型目录>/inswapper_128.onnx')
+    args = parser.parse_args(argv)
+
+    from logs import setup_logging
+
+    setup_logging()
+
+    if args.pairs:
+        pairs = read_pairs(args.pairs)
+    elif args.sources and args.targets:
+        targets = expand_inputs(args.targets)
+        pairs = [(source, target) for source in expand_inputs(args.sources) for target in targets]
+    else:
+        parser.error('需要 --pairs，或同时指定 --sources 和 --targets')
+    if not pairs:
+        parser.error('没有要处理的图片')
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, 'manifest.jsonl'), args.retry_failed)
+    try:
+        done, failed = run(pairs, args.output, manifest, workers=args.workers, onnx_threads=args.onnx_threads,
+                           engine_kwargs={'model_dir': args.model_dir, 'swapper_path': args.swapper})
+    finally:
+        manifest.close()
+    logger.info("批量换脸完成", extra={'done': done, 'failed': failed, 'manifest': manifest.path})
+    # 标准输出只保留最终汇总
+    print(f"完成 {done} 对，失败 {failed} 对，清单: {manifest.path}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
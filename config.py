@@ -0,0 +1,129 @@
+import os
+
+# 所有配置都可以通过环境变量覆盖
+
+
+def _env_list(name, default):
+    value = os.environ.get(name, default)
+    if value.strip().lower() in ('', 'all'):
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# 模型目录，buffalo_l 位于 <MODEL_DIR>/models/buffalo_l
+MODEL_DIR = os.environ.get('FACESWAP_MODEL_DIR', './models')
+
+# 人脸检测参数
+DET_SIZE = int(os.environ.get('FACESWAP_DET_SIZE', '640'))
+DET_THRESH = float(os.environ.get('FACESWAP_DET_THRESH', '0.3'))
+# 人脸检测在长边不超过该值的缩小图上进行，0 表示直接在原图上检测
+DET_PROXY_SIZE = int(os.environ.get('FACESWAP_DET_PROXY_SIZE', '640'))
+
+# 各场景需要运行的 insightface 模块（detection / recognition / landmark_2d_106 /
+# landmark_3d_68 / genderage），设为 all 时运行 buffalo_l 的全部模块
+# 换脸只需要目标人脸的关键点和源人脸的特征向量
+ANALYSIS_PROFILES = {
+    'source': _env_list('FACESWAP_SOURCE_MODULES', 'detection,recognition'),
+    'target': _env_list('FACESWAP_TARGET_MODULES', 'detection'),
+}
+
+# 每个 onnxruntime 会话的线程数，0 表示使用 onnxruntime 默认值（物理核数）
+ONNX_INTRA_OP_THREADS = int(os.environ.get('FACESWAP_ONNX_INTRA_OP_THREADS', '0'))
+ONNX_INTER_OP_THREADS = int(os.environ.get('FACESWAP_ONNX_INTER_OP_THREADS', '0'))
+# 图优化级别：disable / basic / extended / all
+ONNX_GRAPH_OPT_LEVEL = os.environ.get('FACESWAP_ONNX_GRAPH_OPT_LEVEL', 'all')
+# 执行模式：sequential / parallel（parallel 时算子间线程数才有意义）
+ONNX_EXECUTION_MODE = os.environ.get('FACESWAP_ONNX_EXECUTION_MODE', 'sequential')
+# CPU 内存池和内存复用规划
+ONNX_ENABLE_MEM_ARENA = os.environ.get('FACESWAP_ONNX_MEM_ARENA', '1') == '1'
+ONNX_ENABLE_MEM_PATTERN = os.environ.get('FACESWAP_ONNX_MEM_PATTERN', '1') == '1'
+# 优化后模型的缓存目录，首次启动时生成，之后直接加载；设为空字符串表示不缓存
+ONNX_OPTIMIZED_MODEL_DIR = os.environ.get('FACESWAP_ONNX_OPTIMIZED_MODEL_DIR',
+                                          os.path.join(MODEL_DIR, 'optimized'))
+
+# INT8 量化模型（由 model_tools.py quantize 生成，与原模型同名）
+# 要使用量化版本的模型文件名，不含扩展名，如 det_10g,w600k_r50,inswapper_128；all 为全部，留空为不使用
+QUANTIZED_MODEL_DIR = os.environ.get('FACESWAP_QUANTIZED_MODEL_DIR', os.path.join(MODEL_DIR, 'quantized'))
+_quantized_models = os.environ.get('FACESWAP_QUANTIZED_MODELS', '').strip()
+QUANTIZED_MODELS = 'all' if _quantized_models.lower() == 'all' else \
+    [name.strip() for name in _quantized_models.split(',') if name.strip()]
+
+# 动态微批处理：并发请求在该时间窗口（毫秒）内合并成一次推理，0 表示关闭
+# 只对 batch 维度是动态的模型生效（识别模型本身支持，检测和换脸模型需先用
+# model_tools.py dynamic-batch 转换）
+BATCH_WINDOW_MS = float(os.environ.get('FACESWAP_BATCH_WINDOW_MS', '0'))
+BATCH_MAX_SIZE = int(os.environ.get('FACESWAP_BATCH_MAX_SIZE', '8'))
+
+# 异步任务：工作线程数、排队上限、结果保留秒数
+JOB_WORKERS = int(os.environ.get('FACESWAP_JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.environ.get('FACESWAP_JOB_QUEUE_SIZE', '16'))
+JOB_RESULT_TTL = int(os.environ.get('FACESWAP_JOB_RESULT_TTL', '600'))
+
+# 多进程模式：工作进程数（每个进程各自加载一份模型），0 表示在 Web 进程内换脸
+WORKER_PROCESSES = int(os.environ.get('FACESWAP_WORKER_PROCESSES', '0'))
+# 每个工作进程中 onnxruntime 会话的线程数，0 表示按 CPU 核数平均分配
+WORKER_ONNX_THREADS = int(os.environ.get('FACESWAP_WORKER_ONNX_THREADS', '0'))
+
+# 换脸结果缓存：相同上传图片和角色直接返回保存的结果，目录总大小超过上限（MB）时删除最久未用的结果，0 表示关闭
+RESULT_CACHE_DIR = os.environ.get('FACESWAP_RESULT_CACHE_DIR', './cache/results')
+RESULT_CACHE_MAX_MB = int(os.environ.get('FACESWAP_RESULT_CACHE_MAX_MB', '512'))
+# /results/<hash> 的浏览器和代理缓存时间（秒）
+RESULT_CACHE_MAX_AGE = int(os.environ.get('FACESWAP_RESULT_CACHE_MAX_AGE', '86400'))
+
+# 日志级别和格式（json：每行一条 JSON；text：可读文本）
+LOG_LEVEL = os.environ.get('FACESWAP_LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('FACESWAP_LOG_FORMAT', 'json')
+
+# 视频换脸：每隔多少帧重新检测一次人脸（中间帧用光流跟踪关键点）
+VIDEO_KEYFRAME_INTERVAL = int(os.environ.get('FACESWAP_VIDEO_KEYFRAME_INTERVAL', '10'))
+# 视频换脸的并发换脸线程数
+VIDEO_WORKERS = int(os.environ.get('FACESWAP_VIDEO_WORKERS', '2'))
+# 输出视频的编码（cv2.VideoWriter_fourcc），OpenCV 自带 H.264 编码器时可改为 avc1
+VIDEO_FOURCC = os.environ.get('FACESWAP_VIDEO_FOURCC', 'mp4v')
+# 视频任务结果的保存目录，任务过期时删除
+VIDEO_OUTPUT_DIR = os.environ.get('FACESWAP_VIDEO_OUTPUT_DIR', './cache/videos')
+
+# 实时换脸（WebSocket，需要安装 flask-sock）：默认目标帧率
+LIVE_TARGET_FPS = float(os.environ.get('FACESWAP_LIVE_TARGET_FPS', '15'))
+# 处理跟不上目标帧率时依次降低的处理分辨率（相对客户端发送的帧）
+LIVE_SCALES = tuple(float(s) for s in os.environ.get('FACESWAP_LIVE_SCALES', '1.0,0.75,0.5,0.35').split(','))
+# 实时换脸每隔多少帧重新检测人脸
+LIVE_KEYFRAME_INTERVAL = int(os.environ.get('FACESWAP_LIVE_KEYFRAME_INTERVAL', '5'))
+# 返回帧的 JPEG 质量
+LIVE_JPEG_QUALITY = int(os.environ.get('FACESWAP_LIVE_JPEG_QUALITY', '80'))
+# 同时进行的实时换脸会话数上限
+LIVE_MAX_SESSIONS = int(os.environ.get('FACESWAP_LIVE_MAX_SESSIONS', '4'))
+
+# 上传图片的限制：在解码前按文件头中的尺寸检查，超出时直接拒绝
+UPLOAD_MAX_SIDE = int(os.environ.get('FACESWAP_UPLOAD_MAX_SIDE', '12000'))
+UPLOAD_MAX_PIXELS = int(os.environ.get('FACESWAP_UPLOAD_MAX_PIXELS', '50000000'))
+# 上传请求体的大小上限（MB）
+UPLOAD_MAX_MB = int(os.environ.get('FACESWAP_UPLOAD_MAX_MB', '20'))
+# 大图在解码时按 1/2、1/4、1/8 缩小，缩小后的长边不小于该值；0 表示按原尺寸解码
+UPLOAD_DECODE_SIDE = int(os.environ.get('FACESWAP_UPLOAD_DECODE_SIDE', '2000'))
+
+# 结果图片编码：编码线程数、WebP 默认质量、PNG 压缩级别、按目标大小查找质量时的最低质量
+ENCODE_THREADS = int(os.environ.get('FACESWAP_ENCODE_THREADS', '2'))
+WEBP_QUALITY = int(os.environ.get('FACESWAP_WEBP_QUALITY', '90'))
+PNG_COMPRESSION = int(os.environ.get('FACESWAP_PNG_COMPRESSION', '3'))
+ENCODE_MIN_QUALITY = int(os.environ.get('FACESWAP_ENCODE_MIN_QUALITY', '40'))
+# 预览图（preview=true 时）的默认长边和质量
+PREVIEW_SIDE = int(os.environ.get('FACESWAP_PREVIEW_SIDE', '320'))
+PREVIEW_QUALITY = int(os.environ.get('FACESWAP_PREVIEW_QUALITY', '70'))
+
+# 角色目录（static/roles 和其中的 roles.json）的检查间隔（秒），变化时只重新索引新增或修改的角色；0 表示不检查
+ROLE_CHECK_INTERVAL = float(os.environ.get('FACESWAP_ROLE_CHECK_INTERVAL', '2'))
+
+# 角色图库缩略图：宽度（与 srcset 的 w 描述一致，不放大）、格式、质量、缓存目录和 Cache-Control max-age（文件名带版本号，可以长期缓存）
+ROLE_THUMB_WIDTHS = tuple(int(w) for w in os.environ.get('FACESWAP_ROLE_THUMB_WIDTHS', '240,360,480').split(','))
+ROLE_THUMB_FORMAT = os.environ.get('FACESWAP_ROLE_THUMB_FORMAT', 'webp')
+ROLE_THUMB_QUALITY = int(os.environ.get('FACESWAP_ROLE_THUMB_QUALITY', '80'))
+ROLE_THUMB_DIR = os.environ.get('FACESWAP_ROLE_THUMB_DIR', './cache/role_thumbs')
+ROLE_THUMB_MAX_AGE = int(os.environ.get('FACESWAP_ROLE_THUMB_MAX_AGE', str(365 * 86400)))
+# 换脸使用的角色图片最大边长，更大的原图在建立索引时缩小，请求耗时不再取决于原图尺寸；0 表示不限制
+ROLE_TARGET_MAX_SIDE = int(os.environ.get('FACESWAP_ROLE_TARGET_MAX_SIDE', '1600'))
+
+# 浏览器上传前的预处理（/api/upload-limits）：长边缩小到该值以内、重新压缩的格式和质量（0~1）
+CLIENT_UPLOAD_MAX_SIDE = int(os.environ.get('FACESWAP_CLIENT_UPLOAD_MAX_SIDE', '1600'))
+CLIENT_UPLOAD_FORMAT = os.environ.get('FACESWAP_CLIENT_UPLOAD_FORMAT', 'image/jpeg')
+CLIENT_UPLOAD_QUALITY = float(os.environ.get('FACESWAP_CLIENT_UPLOAD_QUALITY', '0.9'))
@@ -0,0 +1,153 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import config
+import metrics
+
+# 结果图片的默认 JPEG 质量
+JPEG_QUALITY = 95
+
+# 格式 -> (扩展名, MIME 类型, 质量参数)，PNG 是无损格式，没有质量参数
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY),
+    'png': ('.png', 'image/png', None),
+}
+DEFAULT_QUALITY = {'jpeg': JPEG_QUALITY, 'webp': config.WEBP_QUALITY}
+
+# 编码结果：完整图片和可选的低分辨率预览图（没有时为 None）
+Encoded = namedtuple('Encoded', ['data', 'preview'])
+
+# cv2.imencode 执行时释放 GIL，放到线程池中可以与其他请求的推理同时进行
+_pool = ThreadPoolExecutor(config.ENCODE_THREADS, thread_name_prefix='encode')
+
+
+class OutputOptions:
+    """结果图片的输出参数
+
+    format 为 jpeg / webp / png；quality 为空时使用该格式的默认质量；max_bytes 不为 0 时
+    在 [ENCODE_MIN_QUALITY, quality] 之间二分查找不超过该大小的最高质量（PNG 忽略）；
+    max_side 不为 0 时把长边缩小到该值以内；preview_side 不为 0 时额外生成长边为该值的预览图。
+    """
+
+    def __init__(self, format='jpeg', quality=None, max_bytes=0, max_side=0, preview_side=0):
+        if format not in FORMATS:
+            raise Exception(f"不支持的输出格式: {format}")
+        if quality is not None and not 1 <= quality <= 100:
+            raise Exception("quality 应在 1~100 之间")
+        if min(max_bytes, max_side, preview_side) < 0:
+            raise Exception("max_bytes、max_side、preview 不能为负数")
+        self.format = format
+        self.quality = quality if quality is not None else DEFAULT_QUALITY.get(format)
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.preview_side = preview_side
+
+    @classmethod
+    def from_params(cls, params):
+        """从请求参数（format、quality、max_bytes、max_side、preview）创建，preview 为 true 时使用默认预览尺寸，false 时不生成"""
+        def value(name, default=None):
+            return params.get(name, [default])[0]
+
+        preview = str(value('preview', '0')).strip().lower()
+        try:
+            if preview in ('true', 'yes', 'on'):
+                preview_side = config.PREVIEW_SIDE
+            elif preview in ('false', 'no', 'off', ''):
+                preview_side = 0
+            else:
+                preview_side = int(preview)
+            return cls(format=str(value('format', 'jpeg')).lower().replace('jpg', 'jpeg'),
+                       quality=int(value('quality')) if value('quality') else None,
+                       max_bytes=int(value('max_bytes', 0)),
+                       max_side=int(value('max_side', 0)),
+                       preview_side=preview_side)
+        except ValueError:
+            raise Exception("无效的输出参数")
+
+    @property
+    def mimetype(self):
+        return FORMATS[self.format][1]
+
+    def __repr__(self):
+        return (f'OutputOptions({self.format!r}, quality={self.quality}, max_bytes={self.max_bytes}, '
+                f'max_side={self.max_side}, preview_side={self.preview_side})')
+
+
+def fit(image, max_side):
+    """把长边缩小到 max_side 以内，max_side 为 0 或图片已经足够小时原样返回"""
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image
+    scale = max_side / max(height, width)
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def _imencode(extension, image, params):
+    success, buffer = cv2.imencode(extension, image, params)
+    if not success:
+        raise Exception("图片编码失败")
+    return buffer.tobytes()
+
+
+def encode_image(image, format='jpeg', quality=None, max_bytes=0):
+    """把图片编码成指定格式
+
+    max_bytes 不为 0 时二分查找不超过该大小的最高质量，最多编码约 log2(质量范围) + 1 次；
+    最低质量仍然超出时返回最低质量的结果
+    """
+    extension, _, flag = FORMATS[format]
+    if flag is None:
+        return _imencode(extension, image, [int(cv2.IMWRITE_PNG_COMPRESSION), config.PNG_COMPRESSION])
+    quality = quality or DEFAULT_QUALITY[format]
+    data = _imencode(extension, image, [int(flag), quality])
+    if not max_bytes or len(data) <= max_bytes:
+        return data
+    low, high = min(config.ENCODE_MIN_QUALITY, quality - 1), quality - 1
+    best = smallest = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _imencode(extension, image, [int(flag), middle])
+        if len(candidate) <= max_bytes:
+            best, low = candidate, middle + 1
+        else:
+            smallest, high = candidate, middle - 1
+    return best if best is not None else smallest
+
+
+def encode_result(image, options):
+    """按输出参数编码一张结果图片，返回 Encoded"""
+    return encode_results([image], options)[0]
+
+
+def encode_results(images, options=None):
+    """在线程池中并行编码多张结果图片和预览图，返回与 images 顺序一致的 Encoded 列表"""
+    options = options or OutputOptions()
+    with metrics.stage('encode'):
+        mains = [_pool.submit(lambda img: encode_image(fit(img, options.max_side), options.format,
+                                                       options.quality, options.max_bytes), image)
+                 for image in images]
+        previews = [_pool.submit(lambda img: encode_image(fit(img, options.preview_side), _preview_format(options),
+                                                          config.PREVIEW_QUALITY), image)
+                    if options.preview_side else None for image in images]
+        return [Encoded(main.result(), preview.result() if preview is not None else None)
+                for main, preview in zip(mains, previews)]
+
+
+def _preview_format(options):
+    # PNG 预览图没有必要无损，改用 JPEG
+    return 'jpeg' if options.format == 'png' else options.format
+
+
+def sniff_mimetype(data):
+    """按文件头判断图片的 MIME 类型"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
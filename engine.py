@@ -0,0 +1,746 @@
+import functools
+import glob
+import hashlib
+import logging
+import os
+import platform
+import threading
+import time
+
+import cv2
+import numpy as np
+import onnxruntime
+from insightface.app.common import Face
+from insightface.model_zoo import ArcFaceONNX, Attribute, Landmark, RetinaFace
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.model_zoo.model_zoo import PickableInferenceSession
+from insightface.model_zoo.retinaface import distance2bbox, distance2kps
+from insightface.utils import ensure_available, face_align
+
+import config
+import metrics
+from batcher import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPT_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+class FaceSwapEngine:
+    """换脸引擎：进程内只加载一次人脸分析与换脸模型，供多个请求共享
+
+    用法：
+        engine = FaceSwapEngine(model_dir='./models')
+        engine.load()            # 启动时加载（重复调用无副作用）
+        faces = engine.detect(img, profile='source')
+        result = engine.swap(target, target_face, source_face)
+        engine.close()           # 释放模型
+    也可以作为上下文管理器使用：with FaceSwapEngine() as engine: ...
+
+    profiles 指定每个场景运行哪些 insightface 模块（见 config.ANALYSIS_PROFILES），
+    只加载所有场景用到的模块，检测时也只运行对应场景需要的模块。
+
+    batch_window_ms > 0 时，支持动态 batch 的检测、识别和换脸会话前面各放一个
+    MicroBatcher，把并发请求合并成一次推理（见 batcher.py）。
+
+    intra_op_threads / inter_op_threads 为每个 onnxruntime 会话的线程数，0 表示使用
+    onnxruntime 的默认值（物理核数）；多进程部署时应按 核数 / 进程数 设置。
+    graph_optimization_level、execution_mode、enable_mem_arena、enable_mem_pattern
+    对应 onnxruntime.SessionOptions 的同名设置。optimized_model_dir 不为空时，首次加载把
+    优化后的模型保存到该目录，之后直接加载优化后的模型，跳过图优化。
+
+    quantized_models 为要改用 INT8 量化版本的模型文件名（不含扩展名，如 det_10g、
+    inswapper_128），'all' 表示全部；量化模型放在 quantized_model_dir 下，与原模型同名
+    （见 model_tools.py quantize）。
+    """
+
+    def __init__(self, model_dir=None, swapper_path=None,
+                 det_size=None, det_thresh=None,
+                 providers=('CPUExecutionProvider',), profiles=None,
+                 batch_window_ms=None, batch_max_size=None,
+                 intra_op_threads=None, inter_op_threads=None,
+                 graph_optimization_level=None, execution_mode=None,
+                 enable_mem_arena=None, enable_mem_pattern=None,
+                 optimized_model_dir=None, quantized_models=None,
+                 quantized_model_dir=None):
+        self.model_dir = model_dir or config.MODEL_DIR
+        self.swapper_path = swapper_path or os.path.join(self.model_dir, 'inswapper_128.onnx')
+        self.det_size = tuple(det_size or (config.DET_SIZE, config.DET_SIZE))
+        self.det_thresh = config.DET_THRESH if det_thresh is None else det_thresh
+        self.providers = list(providers)
+        self.profiles = dict(config.ANALYSIS_PROFILES if profiles is None else profiles)
+        self.batch_window_ms = config.BATCH_WINDOW_MS if batch_window_ms is None else batch_window_ms
+        self.batch_max_size = batch_max_size or config.BATCH_MAX_SIZE
+        self.intra_op_threads = config.ONNX_INTRA_OP_THREADS if intra_op_threads is None else intra_op_threads
+        self.inter_op_threads = config.ONNX_INTER_OP_THREADS if inter_op_threads is None else inter_op_threads
+        self.graph_optimization_level = graph_optimization_level or config.ONNX_GRAPH_OPT_LEVEL
+        self.execution_mode = execution_mode or config.ONNX_EXECUTION_MODE
+        self.enable_mem_arena = config.ONNX_ENABLE_MEM_ARENA if enable_mem_arena is None else enable_mem_arena
+        self.enable_mem_pattern = config.ONNX_ENABLE_MEM_PATTERN if enable_mem_pattern is None else enable_mem_pattern
+        self.optimized_model_dir = config.ONNX_OPTIMIZED_MODEL_DIR if optimized_model_dir is None else optimized_model_dir
+        self.quantized_models = config.QUANTIZED_MODELS if quantized_models is None else quantized_models
+        self.quantized_model_dir = quantized_model_dir or config.QUANTIZED_MODEL_DIR
+        if self.graph_optimization_level not in GRAPH_OPT_LEVELS:
+            raise Exception(f"未知的图优化级别: {self.graph_optimization_level}")
+        if self.execution_mode not in EXECUTION_MODES:
+            raise Exception(f"未知的执行模式: {self.execution_mode}")
+
+        self._analyser = None
+        self._swapper = None
+        self._batchers = {}
+        # 加载/释放模型时加锁，避免并发请求重复加载
+        self._lock = threading.Lock()
+
+    @property
+    def allowed_modules(self):
+        """所有场景用到的模块，任一场景为 None（全部模块）时返回 None"""
+        if any(modules is None for modules in self.profiles.values()):
+            return None
+        modules = {'detection'}
+        for profile_modules in self.profiles.values():
+            modules.update(profile_modules)
+        return sorted(modules)
+
+    @property
+    def loaded(self):
+        return self._analyser is not None and self._swapper is not None
+
+    def load(self):
+        """加载模型，已加载时直接返回"""
+        if self.loaded:
+            return self
+        with self._lock:
+            if self.loaded:
+                return self
+            start = time.perf_counter()
+            os.environ['INSIGHTFACE_HOME'] = self.model_dir
+            onnxruntime.set_default_logger_severity(3)
+
+            analyser = Analyser(ensure_available('models', 'buffalo_l', root=self.model_dir),
+                                self.allowed_modules, self._load_model)
+            analyser.prepare(det_size=self.det_size, det_thresh=self.det_thresh)
+
+            swapper = self._load_model(self.swapper_path)
+            if swapper is None:
+                raise Exception(f"无法加载换脸模型: {self.swapper_path}")
+
+            self._batchers = self._create_batchers(analyser, swapper)
+            self._analyser = analyser
+            self._swapper = swapper
+            seconds = time.perf_counter() - start
+            metrics.MODEL_LOAD_SECONDS.set(seconds, model='all')
+            logger.info("模型加载完成", extra={'seconds': round(seconds, 3)})
+        return self
+
+    def close(self):
+        """释放模型，之后可以重新 load()"""
+        with self._lock:
+            for batcher in self._batchers.values():
+                batcher.close()
+            self._batchers = {}
+            self._analyser = None
+            self._swapper = None
+
+    def _session_options(self):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = GRAPH_OPT_LEVELS[self.graph_optimization_level]
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        options.enable_cpu_mem_arena = self.enable_mem_arena
+        options.enable_mem_pattern = self.enable_mem_pattern
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+        return options
+
+    def _quantized_path(self, model_path):
+        """配置为使用量化版本时返回量化模型路径，否则返回 None"""
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        if self.quantized_models != 'all' and name not in self.quantized_models:
+            return None
+        quantized_path = os.path.join(self.quantized_model_dir, os.path.basename(model_path))
+        if not os.path.isfile(quantized_path):
+            if self.quantized_models != 'all':
+                logger.warning("未找到量化模型，使用原模型", extra={'path': quantized_path})
+            return None
+        return quantized_path
+
+    def _optimized_path(self, model_path):
+        """优化后模型的缓存路径
+
+        优化结果与 onnxruntime 版本、优化级别、执行器和 CPU（all 级别会按指令集选择算子）有关，
+        这些信息连同原模型的大小和修改时间一起写进文件名，任何一项变化都会重新优化；
+        多台机器共用同一个模型目录时各自生成自己的版本。
+        """
+        if not self.optimized_model_dir or self.graph_optimization_level == 'disable':
+            return None
+        stat = os.stat(model_path)
+        key = '|'.join([onnxruntime.__version__, self.graph_optimization_level, cpu_signature(),
+                        ','.join(self.providers), str(stat.st_size), str(stat.st_mtime_ns)])
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.optimized_model_dir, f'{name}.{self.graph_optimization_level}.{digest}.onnx')
+
+    def _load_model(self, model_path):
+        """加载 onnx 模型，按输入输出结构识别成 insightface 对应的模型类"""
+        if not os.path.isfile(model_path):
+            raise Exception(f"模型文件不存在: {model_path}")
+        start = time.perf_counter()
+        # 会话从量化模型创建，模型类仍读取原模型
+        session_path = self._quantized_path(model_path) or model_path
+        options = self._session_options()
+        optimized_path = self._optimized_path(session_path)
+        if optimized_path is not None and os.path.isfile(optimized_path):
+            # 已经优化过，直接加载，不再重复图优化
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            session = PickableInferenceSession(optimized_path, sess_options=options,
+                                               providers=self.providers)
+        elif optimized_path is not None:
+            os.makedirs(self.optimized_model_dir, exist_ok=True)
+            # 多个进程可能同时加载，先写临时文件再替换
+            tmp_path = f'{optimized_path}.{os.getpid()}.tmp'
+            options.optimized_model_filepath = tmp_path
+            session = PickableInferenceSession(session_path, sess_options=options,
+                                               providers=self.providers)
+            if os.path.isfile(tmp_path):
+                os.replace(tmp_path, optimized_path)
+                logger.info("已保存优化后的模型", extra={'path': optimized_path})
+        else:
+            session = PickableInferenceSession(session_path, sess_options=options,
+                                               providers=self.providers)
+        model = route_model(model_path, session)
+        metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - start, model=os.path.basename(model_path))
+        return model
+
+    def _create_batchers(self, analyser, swapper):
+        """为支持动态 batch 的会话创建微批处理器，batch 固定的会话直接调用"""
+        if self.batch_window_ms <= 0:
+            return {}
+        batchers = {}
+
+        def add(name, run_batch):
+            batchers[name] = MicroBatcher(run_batch, max_batch_size=self.batch_max_size,
+                                          window_ms=self.batch_window_ms, name=f'{name}-batcher')
+
+        det_model = analyser.det_model
+        if dynamic_batch(det_model.session):
+            add('detection', lambda imgs: detect_batch(det_model, imgs))
+        rec_model = analyser.models.get('recognition')
+        if rec_model is not None and dynamic_batch(rec_model.session):
+            add('recognition', lambda crops: list(rec_model.get_feat(crops)))
+        if dynamic_batch(swapper.session):
+            def run_swapper(items):
+                blob = np.stack([blob for blob, _ in items])
+                latents = np.stack([latent for _, latent in items])
+                return list(swapper.session.run(swapper.output_names,
+                                                {swapper.input_names[0]: blob,
+                                                 swapper.input_names[1]: latents})[0])
+            add('swapper', run_swapper)
+        logger.info("启用微批处理", extra={'batchers': sorted(batchers)})
+        return batchers
+
+    def __enter__(self):
+        return self.load()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def analyser(self):
+        return self.load()._analyser
+
+    @property
+    def swapper(self):
+        return self.load()._swapper
+
+    def detect(self, img, profile=None, proxy_size=None, adjust=None):
+        """检测人脸（onnxruntime 会话本身支持多线程并发调用）
+
+        profile 为 'source'、'target' 等场景名时只运行该场景需要的模块，
+        为 None 时运行已加载的全部模块，与 FaceAnalysis.get 一致。
+
+        检测在长边不超过 proxy_size 的缩小图上进行（默认 config.DET_PROXY_SIZE，
+        0 表示不缩小），bbox/kps 再映射回原图坐标，特征提取直接在原图上对齐裁剪。
+        adjust=(alpha, beta) 为亮度/对比度调整，只作用于检测缩小图和对齐后的人脸图块。
+        """
+        analyser = self.analyser
+        modules = self.profiles[profile] if profile is not None else None
+        proxy, scale = detection_proxy(img, config.DET_PROXY_SIZE if proxy_size is None else proxy_size)
+        if adjust is not None:
+            proxy = cv2.convertScaleAbs(proxy, alpha=adjust[0], beta=adjust[1])
+
+        with metrics.stage('detection'):
+            if 'detection' in self._batchers:
+                bboxes, kpss = self._batchers['detection'].submit(proxy)
+            else:
+                bboxes, kpss = analyser.det_model.detect(proxy, max_num=0, metric='default')
+        if bboxes.shape[0] == 0:
+            return []
+        if scale != 1.0:
+            bboxes[:, 0:4] /= scale
+            if kpss is not None:
+                kpss /= scale
+
+        faces = [Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None,
+                      det_score=bboxes[i, 4])
+                 for i in range(bboxes.shape[0])]
+        adjusted_img = None
+        for taskname, model in analyser.models.items():
+            if taskname == 'detection' or (modules is not None and taskname not in modules):
+                continue
+            if taskname == 'recognition':
+                self._embed(model, img, faces, adjust)
+                continue
+            if adjusted_img is None:
+                adjusted_img = img if adjust is None else \
+                    cv2.convertScaleAbs(img, alpha=adjust[0], beta=adjust[1])
+            for face in faces:
+                model.get(adjusted_img, face)
+        return faces
+
+    def embed(self, img, faces, adjust=None):
+        """为已检测到的人脸（如角色索引中的人脸）补充特征向量"""
+        model = self.analyser.models.get('recognition')
+        if model is None:
+            raise Exception("未加载识别模型")
+        if faces:
+            self._embed(model, img, faces, adjust)
+        return faces
+
+    def _embed(self, model, img, faces, adjust):
+        # 所有人脸对齐后一次送入识别模型
+        with metrics.stage('recognition'):
+            crops = [face_align.norm_crop(img, landmark=face.kps, image_size=model.input_size[0])
+                     for face in faces]
+            if adjust is not None:
+                crops = [cv2.convertScaleAbs(crop, alpha=adjust[0], beta=adjust[1])
+                         for crop in crops]
+            if 'recognition' in self._batchers:
+                embeddings = self._batchers['recognition'].submit_many(crops)
+            else:
+                embeddings = model.get_feat(crops)
+        for face, embedding in zip(faces, embeddings):
+            face.embedding = embedding.flatten()
+
+    def swap(self, target, target_face, source_face, paste_back=True):
+        """把 source_face 换到 target 图片的 target_face 上"""
+        return self.swapper.get(target, target_face, source_face, paste_back=paste_back)
+
+    def source_latent(self, source_face):
+        """由源人脸的特征向量计算 inswapper 的输入 latent（同一张源图只需计算一次）"""
+        return self.source_latents([source_face])
+
+    def source_latents(self, source_faces):
+        """多个源人脸的 latent，每行一个"""
+        embeddings = np.stack([face.normed_embedding for face in source_faces])
+        latents = np.dot(embeddings, self.swapper.emap)
+        latents /= np.linalg.norm(latents, axis=1, keepdims=True)
+        return latents.astype(np.float32)
+
+    @property
+    def swapper_batch_size(self):
+        """inswapper 会话一次能处理的人脸数，0 表示 batch 维度是动态的"""
+        batch = self.swapper.input_shape[0]
+        return batch if isinstance(batch, int) and batch > 0 else 0
+
+    def paste_template(self, target, target_face, adjust=None, background=None):
+        """为目标人脸生成对齐/贴回模板，固定的目标图片可以缓存模板反复使用
+
+        background 为同一张图片上其他模板调整好的背景，可以避免重复调整整张图片
+        """
+        swapper = self.swapper
+        template = PasteTemplate(target, target_face.kps, swapper.input_size[0], adjust, background)
+        template.blob = cv2.dnn.blobFromImage(template.aimg, 1.0 / swapper.input_std,
+                                              swapper.input_size,
+                                              (swapper.input_mean, swapper.input_mean, swapper.input_mean),
+                                              swapRB=True)
+        return template
+
+    def generate(self, target, target_face, latent):
+        """用预先计算好的 latent 执行换脸并贴回目标图片，结果与 swap() 一致"""
+        return self.generate_batch([self.paste_template(target, target_face)], latent)[0]
+
+    def generate_batch(self, templates, latent):
+        """把同一个源人脸换到多个目标人脸上
+
+        templates 为 paste_template() 生成的模板列表。所有目标人脸的 128x128 对齐图块
+        拼成一个 batch 交给 inswapper；模型的 batch 维度固定时按模型支持的大小分批执行。
+        latent 也可以每行对应一个模板，此时各目标人脸换成不同的源人脸。
+        """
+        pred = self._run_swapper(templates, latent)
+        results = []
+        with metrics.stage('paste_back'):
+            for template, img_fake in zip(templates, pred.transpose((0, 2, 3, 1))):
+                results.append(template.apply(_to_bgr(img_fake)))
+        return results
+
+    def generate_multi(self, templates, latents):
+        """在同一张目标图片上换多个人脸，返回一张结果图片
+
+        templates 为同一张目标图片上各人脸的模板（亮度调整相同），latents 每行对应一个模板。
+        所有人脸在一个 batch 中推理，先在原图像素上依次叠加（相邻人脸的区域可能重叠），
+        再只对人脸区域做亮度调整，人脸以外直接使用模板中预先调整好的背景。
+        """
+        if not templates:
+            raise Exception("没有需要换的人脸")
+        out = templates[0].background.copy()
+        pasted = [template for template in templates if template.roi is not None]
+        pred = self._run_swapper(templates, latents)
+        if not pasted:
+            return out
+        with metrics.stage('paste_back'):
+            top = min(template.roi[0].start for template in pasted)
+            bottom = max(template.roi[0].stop for template in pasted)
+            left = min(template.roi[1].start for template in pasted)
+            right = max(template.roi[1].stop for template in pasted)
+            raw = templates[0].target[top:bottom, left:right].copy()
+            for template, img_fake in zip(templates, pred.transpose((0, 2, 3, 1))):
+                template.blend(_to_bgr(img_fake), raw, (top, left))
+            for template in pasted:
+                template.adjust_into(raw, out, (top, left))
+        return out
+
+    def _run_swapper(self, templates, latent):
+        swapper = self.swapper
+        blob = np.concatenate([template.blob for template in templates], axis=0)
+        latents = latent if len(latent) == len(templates) else np.repeat(latent, len(templates), axis=0)
+        with metrics.stage('inswapper'):
+            if 'swapper' in self._batchers:
+                # 与其他并发请求的人脸合并成一个 batch
+                return np.stack(self._batchers['swapper'].submit_many(list(zip(blob, latents))))
+            step = self.swapper_batch_size or len(templates)
+            preds = []
+            for i in range(0, len(templates), step):
+                preds.append(swapper.session.run(swapper.output_names,
+                                                 {swapper.input_names[0]: blob[i:i + step],
+                                                  swapper.input_names[1]: latents[i:i + step]})[0])
+            return np.concatenate(preds, axis=0)
+
+
+@functools.lru_cache(maxsize=None)
+def cpu_signature():
+    """当前机器的 CPU 标识：架构、型号和指令集标志（Linux 从 /proc/cpuinfo 的第一个处理器读取）"""
+    info = {}
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if not line.strip():
+                    break
+                name, _, value = line.partition(':')
+                info[name.strip()] = value.strip()
+    except OSError:
+        pass
+    model = info.get('model name') or info.get('CPU part') or platform.processor()
+    flags = ' '.join(sorted((info.get('flags') or info.get('Features') or '').split()))
+    return '|'.join([platform.machine(), model, flags])
+
+
+def _to_bgr(img_fake):
+    """inswapper 输出（RGB，0~1）转换成 BGR uint8"""
+    return np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1]
+
+
+class Analyser:
+    """buffalo_l 人脸分析模型集合
+
+    加载规则与 insightface FaceAnalysis 相同（按 allowed_modules 过滤，同类模型只保留第一个），
+    区别是由引擎负责创建 onnxruntime 会话，可以传入会话参数。
+    """
+
+    def __init__(self, model_dir, allowed_modules, load_model):
+        self.models = {}
+        for onnx_file in sorted(glob.glob(os.path.join(model_dir, '*.onnx'))):
+            model = load_model(onnx_file)
+            if model is None:
+                logger.warning("无法识别的模型", extra={'path': onnx_file})
+            elif allowed_modules is not None and model.taskname not in allowed_modules:
+                logger.debug("忽略模型", extra={'path': onnx_file, 'taskname': model.taskname})
+            elif model.taskname not in self.models:
+                logger.info("加载模型", extra={'path': onnx_file, 'taskname': model.taskname})
+                self.models[model.taskname] = model
+            else:
+                logger.warning("模型类型重复，忽略", extra={'path': onnx_file, 'taskname': model.taskname})
+        if 'detection' not in self.models:
+            raise Exception(f"未找到人脸检测模型: {model_dir}")
+        self.det_model = self.models['detection']
+
+    def prepare(self, det_size, det_thresh):
+        for taskname, model in self.models.items():
+            if taskname == 'detection':
+                model.prepare(0, input_size=det_size, det_thresh=det_thresh)
+            else:
+                model.prepare(0)
+
+
+class PasteTemplate:
+    """目标人脸的对齐与贴回模板
+
+    对齐图块、贴回用的仿射矩阵、羽化遮罩和遮罩覆盖的区域只取决于目标图片，
+    固定的角色图片计算一次即可反复使用。贴回（与 insightface INSwapper.get 的逻辑相同，
+    省去了其中计算后并未使用的 fake_diff）和亮度调整都只处理人脸所在的区域。
+    adjust=(alpha, beta) 为贴回后整张图片的亮度/对比度调整，人脸区域以外预先调整好；
+    同一张图片上的多个模板可以通过 background 共用调整好的背景。
+    """
+
+    def __init__(self, target, kps, image_size, adjust=None, background=None):
+        self.aimg, M = face_align.norm_crop2(target, kps, image_size)
+        self.target = target
+        self.adjust = adjust
+        self.blob = None
+        IM = cv2.invertAffineTransform(M)
+        height, width = target.shape[:2]
+
+        # 对齐图块映射回原图后的外接矩形，向外留出腐蚀和模糊需要的边距
+        corners = np.array([[[0, 0], [image_size, 0], [0, image_size], [image_size, image_size]]],
+                           dtype=np.float32)
+        corners = cv2.transform(corners, IM)[0]
+        (cx0, cy0), (cx1, cy1) = np.floor(corners.min(axis=0)), np.ceil(corners.max(axis=0))
+        size_bound = int(np.sqrt(max(cx1 - cx0, 0) * max(cy1 - cy0, 0)))
+        margin = max(size_bound // 10, 10) + max(size_bound // 20, 5) + 2
+        x0, y0 = max(int(cx0) - margin, 0), max(int(cy0) - margin, 0)
+        x1, y1 = min(int(cx1) + margin + 1, width), min(int(cy1) + margin + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            raise Exception("目标人脸不在图片范围内")
+
+        img_white = np.full((image_size, image_size), 255, dtype=np.float32)
+        img_white = cv2.warpAffine(img_white, _shift(IM, x0, y0), (x1 - x0, y1 - y0), borderValue=0.0)
+        img_white[img_white > 20] = 255
+        img_mask = img_white
+        mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+        if len(mask_h_inds) == 0:
+            raise Exception("目标人脸不在图片范围内")
+        mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+        mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+        mask_size = int(np.sqrt(mask_h * mask_w))
+        k = max(mask_size // 10, 10)
+        kernel = np.ones((k, k), np.uint8)
+        img_mask = cv2.erode(img_mask, kernel, iterations=1)
+        k = max(mask_size // 20, 5)
+        blur_size = (2 * k + 1, 2 * k + 1)
+        img_mask = cv2.GaussianBlur(img_mask, blur_size, 0)
+        img_mask /= 255
+
+        if background is not None:
+            # 同一张图片上的多个人脸共用调整好的背景
+            self.background = background
+        elif adjust is None:
+            self.background = target
+        else:
+            self.background = cv2.convertScaleAbs(target, alpha=adjust[0], beta=adjust[1])
+
+        # 只保留遮罩非零的区域（人脸太小时遮罩会被完全腐蚀掉，此时不贴回）
+        rows, cols = np.nonzero(img_mask.any(axis=1))[0], np.nonzero(img_mask.any(axis=0))[0]
+        if len(rows) == 0:
+            self.roi = None
+            return
+        top, bottom = y0 + rows[0], y0 + rows[-1] + 1
+        left, right = x0 + cols[0], x0 + cols[-1] + 1
+        self.roi = (slice(top, bottom), slice(left, right))
+        self.roi_size = (right - left, bottom - top)
+        self.IM = _shift(IM, left, top)
+        self.mask = img_mask[top - y0:bottom - y0, left - x0:right - x0, np.newaxis]
+        self.base = (1 - self.mask) * target[self.roi].astype(np.float32)
+
+    def apply(self, bgr_fake, out=None):
+        """把生成的人脸贴回，out 为 None 时复制一份背景，否则直接写入 out 的人脸区域"""
+        if out is None:
+            out = self.background.copy()
+        if self.roi is None:
+            return out
+        fake = cv2.warpAffine(bgr_fake, self.IM, self.roi_size, borderValue=0.0)
+        merged = (self.mask * fake + self.base).astype(np.uint8)
+        if self.adjust is not None:
+            merged = cv2.convertScaleAbs(merged, alpha=self.adjust[0], beta=self.adjust[1])
+        out[self.roi] = merged
+        return out
+
+    def blend(self, bgr_fake, out, origin=(0, 0)):
+        """把生成的人脸按遮罩叠加到 out 当前的像素上，不做亮度调整
+
+        与 apply 不同，人脸以外的部分取 out 中已有的像素，同一张图片上的多个人脸依次叠加时
+        不会互相覆盖。out 可以是原图的一部分，origin 为其左上角在原图中的坐标 (y, x)。
+        """
+        if self.roi is None:
+            return out
+        roi = self._local_roi(origin)
+        fake = cv2.warpAffine(bgr_fake, self.IM, self.roi_size, borderValue=0.0)
+        out[roi] = (self.mask * fake + (1 - self.mask) * out[roi]).astype(np.uint8)
+        return out
+
+    def adjust_into(self, raw, out, origin=(0, 0)):
+        """把 raw（原图的一部分，左上角为 origin）中本模板人脸区域的像素做亮度调整后写入 out"""
+        if self.roi is None:
+            return out
+        merged = raw[self._local_roi(origin)]
+        if self.adjust is not None:
+            merged = cv2.convertScaleAbs(merged, alpha=self.adjust[0], beta=self.adjust[1])
+        out[self.roi] = merged
+        return out
+
+    def _local_roi(self, origin):
+        rows, cols = self.roi
+        return (slice(rows.start - origin[0], rows.stop - origin[0]),
+                slice(cols.start - origin[1], cols.stop - origin[1]))
+
+
+def _shift(M, x, y):
+    """仿射矩阵的输出坐标平移 (-x, -y)，用于只在局部区域内 warpAffine"""
+    M = M.copy()
+    M[:, 2] -= (x, y)
+    return M
+
+
+def route_model(model_file, session):
+    """按输入输出结构把会话包装成 insightface 对应的模型类，规则与 ModelRouter.get_model 相同
+
+    会话可以来自优化后的模型文件，模型类初始化时仍读取原始模型（emap、均值方差等），
+    这些信息在优化后的模型里可能已被移除。
+    """
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    outputs = session.get_outputs()
+
+    if len(outputs) >= 5:
+        return RetinaFace(model_file=model_file, session=session)
+    elif input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_file, session=session)
+    elif input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_file, session=session)
+    elif len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        return INSwapper(model_file=model_file, session=session)
+    elif input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_file, session=session)
+    return None
+
+
+def dynamic_batch(session):
+    """onnxruntime 会话的第一个输入是否支持任意 batch 大小"""
+    batch = session.get_inputs()[0].shape[0]
+    return not isinstance(batch, int)
+
+
+def detect_batch(det_model, imgs):
+    """对多张图片做一次批量人脸检测，结果与逐张调用 det_model.detect(img) 相同
+
+    需要检测模型的 batch 维度是动态的（见 model_tools.py dynamic-batch）
+    """
+    blob, det_scales = detection_blob(det_model, imgs)
+    net_outs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+    # 输出可能带 batch 维度，也可能把 batch 摊平到第一维
+    net_outs = [out.reshape(len(imgs), -1, out.shape[-1]) for out in net_outs]
+    return [_decode_detections(det_model, [out[i] for out in net_outs], det_scale)
+            for i, det_scale in enumerate(det_scales)]
+
+
+def detection_blob(det_model, imgs):
+    """按 RetinaFace.detect 的方式把图片缩放补边后拼成检测模型的输入，返回 (blob, 缩放比例列表)"""
+    input_size = det_model.input_size
+    det_imgs, det_scales = [], []
+    for img in imgs:
+        # 与 RetinaFace.detect 相同的等比缩放和补边
+        im_ratio = float(img.shape[0]) / img.shape[1]
+        model_ratio = float(input_size[1]) / input_size[0]
+        if im_ratio > model_ratio:
+            new_height = input_size[1]
+            new_width = int(new_height / im_ratio)
+        else:
+            new_width = input_size[0]
+            new_height = int(new_width * im_ratio)
+        det_img = np.zeros((input_size[1], input_size[0], 3), dtype=np.uint8)
+        det_img[:new_height, :new_width, :] = cv2.resize(img, (new_width, new_height))
+        det_imgs.append(det_img)
+        det_scales.append(float(new_height) / img.shape[0])
+
+    mean = det_model.input_mean
+    blob = cv2.dnn.blobFromImages(det_imgs, 1.0 / det_model.input_std, input_size,
+                                  (mean, mean, mean), swapRB=True)
+    return blob, det_scales
+
+
+def _decode_detections(det_model, net_outs, det_scale):
+    """单张图片的检测输出解码和 NMS，与 RetinaFace.forward/detect（max_num=0）相同"""
+    input_width, input_height = det_model.input_size
+    fmc = det_model.fmc
+    scores_list, bboxes_list, kpss_list = [], [], []
+    for idx, stride in enumerate(det_model._feat_stride_fpn):
+        scores = net_outs[idx]
+        bbox_preds = net_outs[idx + fmc] * stride
+        height, width = input_height // stride, input_width // stride
+        key = (height, width, stride)
+        anchor_centers = det_model.center_cache.get(key)
+        if anchor_centers is None:
+            anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+            anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+            if det_model._num_anchors > 1:
+                anchor_centers = np.stack([anchor_centers] * det_model._num_anchors,
+                                          axis=1).reshape((-1, 2))
+            det_model.center_cache[key] = anchor_centers
+
+        pos_inds = np.where(scores >= det_model.det_thresh)[0]
+        bboxes = distance2bbox(anchor_centers, bbox_preds)
+        scores_list.append(scores[pos_inds])
+        bboxes_list.append(bboxes[pos_inds])
+        if det_model.use_kps:
+            kpss = distance2kps(anchor_centers, net_outs[idx + fmc * 2] * stride)
+            kpss = kpss.reshape((kpss.shape[0], -1, 2))
+            kpss_list.append(kpss[pos_inds])
+
+    scores = np.vstack(scores_list)
+    order = scores.ravel().argsort()[::-1]
+    bboxes = np.vstack(bboxes_list) / det_scale
+    pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)[order, :]
+    keep = det_model.nms(pre_det)
+    det = pre_det[keep, :]
+    kpss = None
+    if det_model.use_kps:
+        kpss = (np.vstack(kpss_list) / det_scale)[order, :, :][keep, :, :]
+    return det, kpss
+
+
+def detection_proxy(img, max_side):
+    """把图片缩小到长边不超过 max_side，返回 (缩小图, 缩放比例)；不需要缩小时返回原图"""
+    height, width = img.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return img, 1.0
+    scale = max_side / max(height, width)
+    proxy = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    # 按实际缩放后的尺寸计算比例，避免取整带来的坐标偏差
+    return proxy, proxy.shape[1] / width
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(**kwargs):
+    """获取进程内共享的引擎实例（首次调用时创建并加载模型）
+
+    之后的调用不带参数时直接返回该实例；带参数时按默认值和 config 解析后与该实例的参数比较，
+    不同时报错，避免 swapper_path 等参数被静默忽略
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = FaceSwapEngine(**kwargs).load()
+                return _engine
+    if kwargs:
+        # 构造函数只解析参数，不加载模型
+        requested = FaceSwapEngine(**kwargs)
+        different = {name: getattr(requested, name) for name in kwargs
+                     if getattr(requested, name) != getattr(_engine, name)}
+        if different:
+            raise Exception(f"共享引擎已用不同的参数创建，无法再使用 {different}，"
+                            f"当前的参数为 { {name: getattr(_engine, name) for name in different} }")
+    return _engine
@@ -1,10 +1,9 @@
 import cv2
 import numpy as np
-import insightface
-from insightface.app import FaceAnalysis
-import os
 import base64
 
+from engine import get_engine
+
 def image_to_base64(image):
     """将图片转换为base64字符串"""
     # 将图片编码成 jpg 格式的字节流
@@ -21,17 +20,11 @@ def base64_to_image(base64_string):
     # 解码图片
     return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-def swap_face(source_img, target_img_path, model_path, source_is_base64=False):
+def swap_face(source_img, target_img_path, model_path=None, source_is_base64=False):
     """修改后的换脸函数，支持base64输入"""
-    # 初始化人脸检测器
-    model_dir = '/data/xxtcode/ltz/faceswap_setup/models'
-    os.environ['INSIGHTFACE_HOME'] = model_dir
-
-    app = FaceAnalysis(name='buffalo_l', root=model_dir, providers=['CPUExecutionProvider'])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    
-    # 加载换脸模型
-    swapper = insightface.model_zoo.get_model(model_path)
+    # 共享引擎：同一进程内多次调用只加载一次模型；模型目录见 config.MODEL_DIR（FACESWAP_MODEL_DIR），
+    # model_path 为空时使用其中的 inswapper_128.onnx；检测阈值见 config.DET_THRESH（FACESWAP_DET_THRESH）
+    engine = get_engine(swapper_path=model_path) if model_path else get_engine()
 
     # 处理源图片（用户上传的图片）
     if source_is_base64:
@@ -48,18 +41,18 @@ def swap_face(source_img, target_img_path, model_path, source_is_base64=False):
         raise Exception(f"Could not load target image: {target_img_path}")
 
     # 检测人脸
-    source_faces = app.get(source)
+    source_faces = engine.detect(source, profile='source')
     if len(source_faces) == 0:
         raise Exception("No face found in source image")
     source_face = source_faces[0]
     
-    target_faces = app.get(target)
+    target_faces = engine.detect(target, profile='target')
     if len(target_faces) == 0:
         raise Exception("No face found in target image")
     target_face = target_faces[0]
 
     # 执行换脸
-    result = swapper.get(target, target_face, source_face)
+    result = engine.swap(target, target_face, source_face)
     
     # 将结果转换为base64
     return image_to_base64(result)
@@ -70,11 +63,9 @@ if __name__ == "__main__":
         print("Usage: python face_swap.py <source_image> <target_image> <output_image>")
         sys.exit(1)
 
-    # 设置模型路径
-    model_path = "/data/xxtcode/ltz/faceswap_setup/models/inswapper_128.onnx"
-    
+    # 批量处理请使用 bulk.py
     try:
-        result = swap_face(sys.argv[1], sys.argv[2], model_path)
+        result = swap_face(sys.argv[1], sys.argv[2])
         print(result)
     except Exception as e:
         print(f"Error: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,156 @@
+import struct
+
+import cv2
+import numpy as np
+
+import config
+import metrics
+
+# (缩小倍数, imdecode 标志)，JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2), (1, cv2.IMREAD_COLOR))
+
+# JPEG 中带有图片尺寸的 SOF 标记
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageRejected(Exception):
+    """上传的图片格式不支持或尺寸超出限制"""
+
+
+def read_header(data):
+    """不解码像素，从文件头读取 (格式, 宽, 高, EXIF 方向)
+
+    支持 JPEG、PNG、WebP、BMP；无法识别时返回 None。EXIF 方向只从 JPEG 中读取，其余格式为 1。
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return _jpeg_header(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height, 1
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp_header(data)
+    if data[:2] == b'BM' and len(data) >= 26:
+        width, height = struct.unpack('<ii', data[18:26])
+        return 'bmp', width, abs(height), 1
+    return None
+
+
+def _jpeg_header(data):
+    orientation = 1
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # 填充字节
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+        if marker == 0xE1 and segment[:6] == b'Exif\x00\x00':
+            orientation = _exif_orientation(segment[6:]) or orientation
+        elif marker in _SOF_MARKERS and len(segment) >= 5:
+            height, width = struct.unpack('>HH', segment[1:5])
+            return 'jpeg', width, height, orientation
+        elif marker == 0xDA:
+            # 图像数据开始前还没有 SOF
+            return None
+        offset += 2 + length
+    return None
+
+
+def _exif_orientation(tiff):
+    """从 EXIF 的 TIFF 结构中读取 IFD0 的 Orientation（0x0112）"""
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    try:
+        ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+        count = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+        for i in range(count):
+            entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+            tag, _, _, value = struct.unpack(endian + 'HHIH', entry[:10])
+            if tag == 0x0112:
+                return value if 1 <= value <= 8 else None
+    except struct.error:
+        return None
+    return None
+
+
+def _webp_header(data):
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        return 'webp', width & 0x3FFF, height & 0x3FFF, 1
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits = struct.unpack('<I', data[21:25])[0]
+        return 'webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return 'webp', width, height, 1
+    return None
+
+
+def apply_orientation(image, orientation):
+    """按 EXIF 方向把图片转正
+
+    5（LeftTop）为转置，7（RightBottom）为反转置（转置后再旋转 180 度）
+    """
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+
+def decode_upload_image(data, max_side=None, max_pixels=None, target_side=None):
+    """解码上传的图片，返回转正后的 BGR 图像
+
+    先从文件头读取尺寸：格式不支持、边长超过 max_side 或像素数超过 max_pixels 时直接拒绝，
+    不分配像素内存。长边远大于 target_side 时用 IMREAD_REDUCED_COLOR_2/4/8 在解码时直接缩小，
+    缩小后的长边仍不小于 target_side。EXIF 方向在解码后自行处理。
+    """
+    max_side = config.UPLOAD_MAX_SIDE if max_side is None else max_side
+    max_pixels = config.UPLOAD_MAX_PIXELS if max_pixels is None else max_pixels
+    target_side = config.UPLOAD_DECODE_SIDE if target_side is None else target_side
+
+    header = read_header(data)
+    if header is None:
+        raise ImageRejected("不支持的图片格式，请上传 JPEG、PNG、WebP 或 BMP 图片")
+    _, width, height, orientation = header
+    if width <= 0 or height <= 0:
+        raise ImageRejected("无法读取图片尺寸")
+    if max(width, height) > max_side or width * height > max_pixels:
+        raise ImageRejected(f"图片尺寸过大（{width}x{height}），"
+                            f"边长不能超过 {max_side}，像素数不能超过 {max_pixels}")
+
+    flags = cv2.IMREAD_COLOR
+    if target_side > 0:
+        for factor, reduced in REDUCED_FLAGS:
+            if max(width, height) >= target_side * factor:
+                flags = reduced
+                break
+    with metrics.stage('decode'):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise Exception("无法加载源图片")
+    return apply_orientation(image, orientation)
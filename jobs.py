@@ -0,0 +1,198 @@
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# 当前工作线程正在执行的任务，供任务函数通过 report_progress() 报告进度
+_local = threading.local()
+
+
+class QueueFull(Exception):
+    """任务队列已满"""
+
+    def __init__(self, retry_after):
+        super().__init__("任务队列已满，请稍后重试")
+        self.retry_after = retry_after
+
+
+class FileResult:
+    """保存在磁盘上的任务结果（如视频），任务过期时删除文件"""
+
+    def __init__(self, path, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def report_progress(progress):
+    """在任务函数中调用，报告完成比例（0~1）；不在任务中调用时什么也不做"""
+    job = getattr(_local, 'job', None)
+    if job is not None:
+        job.set_progress(progress)
+
+
+class Job:
+    """异步任务，status 依次为 queued -> running -> done / failed"""
+
+    def __init__(self, func, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        info = {'id': self.id, 'status': self.status}
+        if self.started_at is not None:
+            info['wait_seconds'] = round(self.started_at - self.created_at, 3)
+        if self.finished_at is not None:
+            info['run_seconds'] = round(self.finished_at - self.started_at, 3)
+        if self.progress is not None and not self.finished:
+            info['progress'] = self.progress
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+    def set_progress(self, progress):
+        """更新进度，只保留两位小数，变化时唤醒等待的客户端"""
+        progress = round(progress, 2)
+        with self._changed:
+            if progress == self.progress:
+                return
+            self.progress = progress
+            self._changed.notify_all()
+
+    def wait(self, timeout=None):
+        """等待任务状态或进度变化，返回当前状态"""
+        with self._changed:
+            if not self.finished:
+                self._changed.wait(timeout)
+            return self.status
+
+    def _set_status(self, status):
+        with self._changed:
+            self.status = status
+            self._changed.notify_all()
+
+
+class JobQueue:
+    """有界任务队列 + 固定数量的工作线程
+
+    队列满时 submit() 抛出 QueueFull，其中 retry_after 是按最近任务耗时估算的等待秒数。
+    已完成的任务保留 result_ttl 秒供客户端查询结果。
+    """
+
+    def __init__(self, workers=2, max_queued=16, result_ttl=600):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        # 最近任务耗时的指数滑动平均，用于估算 Retry-After
+        self._avg_seconds = None
+        self._threads = []
+
+    def start(self):
+        """启动工作线程，重复调用无副作用"""
+        with self._lock:
+            if self._threads:
+                return self
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'swap-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    @property
+    def depth(self):
+        """排队中的任务数"""
+        return self._queue.qsize()
+
+    @property
+    def running(self):
+        return self._running
+
+    def submit(self, func, *args, **kwargs):
+        self.start()
+        self._purge()
+        job = Job(func, args, kwargs)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFull(self.retry_after())
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def retry_after(self):
+        """估算队列空出位置需要的秒数"""
+        avg = self._avg_seconds or 1.0
+        return max(1, math.ceil(avg * (self.depth + self._running) / self.workers))
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                self._running += 1
+            job.started_at = time.time()
+            job._set_status('running')
+            _local.job = job
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+                status = 'done'
+            except Exception as e:
+                logger.warning("任务失败", extra={'job_id': job.id, 'error': str(e)})
+                job.error = str(e)
+                status = 'failed'
+            finally:
+                _local.job = None
+            job.finished_at = time.time()
+            # 任务参数里可能有上传的图片，完成后释放
+            job.func = job.args = job.kwargs = None
+            with self._lock:
+                self._running -= 1
+                seconds = job.finished_at - job.started_at
+                self._avg_seconds = seconds if self._avg_seconds is None else \
+                    0.8 * self._avg_seconds + 0.2 * seconds
+            job._set_status(status)
+            self._queue.task_done()
+
+    def _purge(self):
+        """清理超过保留时间的已完成任务"""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and now - job.finished_at > self.result_ttl]
+            expired = [self._jobs.pop(job_id) for job_id in expired]
+        for job in expired:
+            if isinstance(job.result, FileResult):
+                job.result.remove()
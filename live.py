@@ -0,0 +1,190 @@
+import json
+import logging
+import threading
+import time
+
+import cv2
+
+import config
+import metrics
+from engine import get_engine
+from pipeline import decode_image, load_source_face
+from video import KeypointTracker, swap_frame
+
+logger = logging.getLogger(__name__)
+
+LIVE_SESSIONS = metrics.Gauge('faceswap_live_sessions', '当前的实时换脸会话数')
+LIVE_FRAMES = metrics.Counter('faceswap_live_frames_total', '实时换脸收到的帧数（处理 / 丢弃）', ['result'])
+LIVE_LATENCY = metrics.Histogram('faceswap_live_frame_seconds', '实时换脸从收到一帧到发回结果的耗时（秒）')
+
+# 同时进行的会话数上限
+_sessions = threading.BoundedSemaphore(config.LIVE_MAX_SESSIONS)
+
+
+class LatestFrame:
+    """只保留最新一帧的信箱：处理线程还没取走旧帧时，新帧直接替换旧帧"""
+
+    def __init__(self):
+        self.dropped = 0
+        self._item = None
+        self._closed = False
+        self._changed = threading.Condition()
+
+    def put(self, item):
+        with self._changed:
+            if self._item is not None:
+                self.dropped += 1
+                LIVE_FRAMES.inc(result='dropped')
+            self._item = item
+            self._changed.notify()
+
+    def take(self):
+        """取走最新一帧，没有新帧时等待；关闭后返回 None"""
+        with self._changed:
+            while self._item is None and not self._closed:
+                self._changed.wait()
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._item = None
+            self._changed.notify_all()
+
+
+class LiveSession:
+    """一个实时换脸连接
+
+    协议：客户端先发送文本消息 {"source": <base64 data URL>, "fps": 15}，服务器计算源人脸 latent 后回复
+    {"type": "ready"}；之后客户端以二进制消息发送 JPEG 帧，服务器对每个处理的帧先回复换脸后的 JPEG，
+    再回复 {"type": "frame", "latency_ms": ..., "dropped": ..., "scale": ...}。
+    处理不过来的帧直接丢弃，只处理最新一帧；处理耗时超过帧间隔时自动降低处理分辨率，有余量时再恢复。
+    会话中再次发送 {"source": ...} 或 {"fps": ...} 可以更换源人脸或目标帧率。
+    """
+
+    def __init__(self, ws, engine):
+        self.ws = ws
+        self.engine = engine
+        self.latent = None
+        self.budget = 1.0 / config.LIVE_TARGET_FPS
+        self.frames = LatestFrame()
+        self._level = 0
+        self._avg_seconds = None
+        self._since_change = 0
+        self.tracker = KeypointTracker(engine, config.LIVE_KEYFRAME_INTERVAL)
+
+    @property
+    def scale(self):
+        return config.LIVE_SCALES[self._level]
+
+    def run(self):
+        try:
+            self._control(json.loads(self.ws.receive()))
+        except Exception as e:
+            self._send_json({'type': 'error', 'error': str(e)})
+            return
+        if self.latent is None:
+            self._send_json({'type': 'error', 'error': '请先发送源图片'})
+            return
+        self._send_json({'type': 'ready'})
+
+        worker = threading.Thread(target=self._process, name='live-swap', daemon=True)
+        worker.start()
+        try:
+            while True:
+                data = self.ws.receive()
+                if isinstance(data, str):
+                    self._control(json.loads(data))
+                elif data is not None:
+                    self.frames.put((data, time.perf_counter()))
+        except Exception as e:
+            # 客户端断开连接时 receive() 抛出异常
+            logger.debug("实时换脸连接结束", extra={'error': str(e)})
+        finally:
+            self.frames.close()
+            worker.join()
+        logger.info("实时换脸会话结束", extra={'dropped': self.frames.dropped, 'scale': self.scale})
+
+    def _control(self, message):
+        """处理客户端的文本控制消息"""
+        if 'fps' in message:
+            self.budget = 1.0 / max(1.0, float(message['fps']))
+        if 'source' in message:
+            self.latent = load_source_face(self.engine, message['source'], source_is_base64=True).latent
+
+    def _process(self):
+        while True:
+            item = self.frames.take()
+            if item is None:
+                return
+            data, received_at = item
+            start = time.perf_counter()
+            try:
+                result = self._swap(data)
+            except Exception as e:
+                if not self._send_json({'type': 'error', 'error': str(e)}):
+                    return
+                continue
+            now = time.perf_counter()
+            self._adapt(now - start)
+            LIVE_FRAMES.inc(result='processed')
+            LIVE_LATENCY.observe(now - received_at)
+            try:
+                self.ws.send(result)
+            except Exception:
+                return
+            if not self._send_json({'type': 'frame', 'latency_ms': round((now - received_at) * 1000, 1),
+                                    'dropped': self.frames.dropped, 'scale': self.scale}):
+                return
+
+    def _swap(self, data):
+        frame = decode_image(data)
+        if self.scale < 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        kps = self.tracker.update(frame)
+        if kps is not None:
+            frame = swap_frame(self.engine, frame, kps, self.latent)
+        with metrics.stage('encode'):
+            success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), config.LIVE_JPEG_QUALITY])
+        if not success:
+            raise Exception("图片编码失败")
+        return buffer.tobytes()
+
+    def _adapt(self, seconds):
+        """按最近的处理耗时调整处理分辨率，每次调整后至少观察 10 帧再调整"""
+        self._avg_seconds = seconds if self._avg_seconds is None else 0.8 * self._avg_seconds + 0.2 * seconds
+        self._since_change += 1
+        if self._since_change < 10:
+            return
+        level = self._level
+        if self._avg_seconds > self.budget and level < len(config.LIVE_SCALES) - 1:
+            level += 1
+        elif self._avg_seconds < 0.5 * self.budget and level > 0:
+            level -= 1
+        if level != self._level:
+            self._level = level
+            self._avg_seconds = None
+            self._since_change = 0
+            # 分辨率变了，跟踪的关键点坐标不再有效
+            self.tracker = KeypointTracker(self.engine, config.LIVE_KEYFRAME_INTERVAL)
+
+    def _send_json(self, message):
+        """发送文本消息，连接已断开时返回 False"""
+        try:
+            self.ws.send(json.dumps(message, ensure_ascii=False))
+            return True
+        except Exception:
+            return False
+
+
+def serve(ws, engine=None):
+    """处理一个实时换脸 WebSocket 连接，会话数达到上限时回复错误并关闭"""
+    if not _sessions.acquire(blocking=False):
+        ws.send(json.dumps({'type': 'error', 'error': '实时换脸人数已满，请稍后重试'}, ensure_ascii=False))
+        return
+    try:
+        with LIVE_SESSIONS.track():
+            LiveSession(ws, engine or get_engine()).run()
+    finally:
+        _sessions.release()
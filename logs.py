@@ -0,0 +1,53 @@
+import json
+import logging
+import sys
+import time
+
+import config
+
+# LogRecord 自带的属性，其余属性都是通过 extra 传入的结构化字段
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，extra 传入的字段原样保留"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                    + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """可读的单行文本，extra 字段以 key=value 形式附在消息后面"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s[%(process)d] %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        fields = ' '.join(f'{key}={value}' for key, value in vars(record).items()
+                          if key not in _RESERVED and not key.startswith('_'))
+        return f'{text} {fields}' if fields else text
+
+
+def setup_logging(level=None, fmt=None):
+    """配置根日志输出到 stderr，重复调用时替换之前的配置"""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if (fmt or config.LOG_FORMAT) == 'json' else TextFormatter())
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel((level or config.LOG_LEVEL).upper())
@@ -0,0 +1,216 @@
+import argparse
+import glob
+import os
+
+import cv2
+import numpy as np
+import onnx
+import onnxruntime
+from insightface.model_zoo import ArcFaceONNX, RetinaFace
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
+from onnx import numpy_helper
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, \
+    quantize_dynamic, quantize_static
+
+import config
+from engine import FaceSwapEngine, detection_blob, detection_proxy, route_model
+
+try:
+    # onnxruntime 1.13 之后才有量化前的预处理
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+except ImportError:
+    quant_pre_process = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def make_dynamic_batch(src_path, dst_path, check=True):
+    """把 batch 维度固定为 1 的模型（如 inswapper_128.onnx、det_10g.onnx）改写成动态 batch
+
+    改写后一次 session.run 可以处理多个人脸。check=True 时用随机输入对比
+    改写前后的输出，结果不一致会抛出异常，不保存改写后的模型。
+    """
+    model = onnx.load(src_path)
+    graph = model.graph
+    initializers = {init.name: init for init in graph.initializer}
+
+    for value in list(graph.input) + list(graph.output):
+        if value.name in initializers:
+            continue
+        dim = value.type.tensor_type.shape.dim[0]
+        dim.ClearField('dim_value')
+        dim.dim_param = 'N'
+
+    # Reshape 中写死的 batch=1 改成 0（沿用输入的 batch 维度）
+    for node in graph.node:
+        if node.op_type != 'Reshape' or node.input[1] not in initializers:
+            continue
+        init = initializers[node.input[1]]
+        shape = numpy_helper.to_array(init).copy()
+        if shape.ndim == 1 and len(shape) > 1 and shape[0] == 1:
+            shape[0] = 0
+            init.CopyFrom(numpy_helper.from_array(shape, init.name))
+
+    # 中间张量的形状推断结果里也写死了 batch，清掉让 onnxruntime 重新推断
+    del graph.value_info[:]
+
+    if check:
+        _check_batch(src_path, model.SerializeToString())
+    onnx.save(model, dst_path)
+    print(f"已保存动态 batch 模型: {dst_path}")
+
+
+def _check_batch(src_path, dynamic_model, batch=3):
+    single = onnxruntime.InferenceSession(src_path, providers=['CPUExecutionProvider'])
+    batched = onnxruntime.InferenceSession(dynamic_model, providers=['CPUExecutionProvider'])
+    rng = np.random.RandomState(0)
+    feeds = {}
+    for inp in single.get_inputs():
+        # 未固定的空间维度（如检测模型的输入宽高）用 128 代替
+        shape = [batch] + [d if isinstance(d, int) else 128 for d in inp.shape[1:]]
+        feeds[inp.name] = rng.rand(*shape).astype(np.float32)
+    singles = [single.run(None, {name: value[i:i + 1] for name, value in feeds.items()})
+               for i in range(batch)]
+    actual = batched.run(None, feeds)
+    diff = 0.0
+    for k, out in enumerate(actual):
+        # 输出可能带 batch 维度，也可能把 batch 摊平到第一维，两种情况都按第一维拼接比较
+        expected = np.concatenate([outs[k] for outs in singles])
+        diff = max(diff, float(np.abs(expected - out.reshape(expected.shape)).max()))
+    if diff > 1e-3:
+        raise Exception(f"动态 batch 模型输出与原模型不一致（最大误差 {diff}）")
+    print(f"动态 batch 校验通过（最大误差 {diff:.2e}）")
+
+
+def quantize_model(src_path, dst_path=None, mode='dynamic', calib_dir=None, limit=64,
+                   per_channel=False):
+    """生成 INT8 量化模型，默认保存到 config.QUANTIZED_MODEL_DIR 下与原模型同名的文件
+
+    mode='dynamic'：只量化权重，激活值在推理时动态量化，不需要校准数据；
+    mode='static'：权重和激活值都量化（QDQ 格式），用 calib_dir 中的照片按实际推理流程
+    生成模型输入做校准，速度通常更快，误差也更大。
+    量化效果因模型而异，切换前先用 python benchmark.py quantized 对比误差和速度。
+    """
+    if mode not in ('dynamic', 'static'):
+        raise Exception(f"未知的量化方式: {mode}")
+    if mode == 'static' and not calib_dir:
+        raise Exception("静态量化需要校准图片目录")
+    dst_path = dst_path or os.path.join(config.QUANTIZED_MODEL_DIR, os.path.basename(src_path))
+    os.makedirs(os.path.dirname(dst_path) or '.', exist_ok=True)
+
+    # 量化前先做图优化和形状推断，量化后的模型更小、更快
+    if quant_pre_process is not None:
+        pre_path = dst_path + '.pre.onnx'
+        quant_pre_process(src_path, pre_path, skip_symbolic_shape=True)
+    else:
+        print("当前 onnxruntime 版本不支持量化预处理，直接量化原模型")
+        pre_path = src_path
+    try:
+        if mode == 'dynamic':
+            quantize_dynamic(pre_path, dst_path, per_channel=per_channel, weight_type=QuantType.QUInt8)
+        else:
+            feeds = calibration_feeds(src_path, calibration_images(calib_dir, limit))
+            if not feeds:
+                raise Exception(f"校准图片中没有可用的人脸: {calib_dir}")
+            print(f"校准样本数: {len(feeds)}")
+            quantize_static(pre_path, dst_path, CalibrationReader(feeds),
+                            quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    finally:
+        if pre_path != src_path:
+            os.remove(pre_path)
+    print(f"已保存量化模型: {dst_path}")
+    return dst_path
+
+
+class CalibrationReader(CalibrationDataReader):
+    """按顺序返回预先生成的模型输入"""
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self._index = 0
+
+    def get_next(self):
+        if self._index >= len(self.feeds):
+            return None
+        self._index += 1
+        return self.feeds[self._index - 1]
+
+    def rewind(self):
+        self._index = 0
+
+
+def calibration_images(path, limit=None):
+    """读取目录（含子目录）中的图片，返回 [(文件名, BGR 图像)]"""
+    paths = sorted(p for p in glob.glob(os.path.join(path, '**', '*'), recursive=True)
+                   if p.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for image_path in paths[:limit]:
+        img = cv2.imread(image_path)
+        if img is None:
+            print(f"无法读取图片，跳过: {image_path}")
+            continue
+        images.append((image_path, img))
+    return images
+
+
+def calibration_feeds(model_path, images):
+    """用 FP32 引擎按实际推理流程为 model_path 生成输入
+
+    检测模型：检测缩小图补边后的输入；识别模型：按检测关键点对齐的人脸；
+    换脸模型：对齐的目标人脸 + 另一张照片中人脸的 latent。
+    """
+    model = route_model(model_path, onnxruntime.InferenceSession(model_path,
+                                                                 providers=['CPUExecutionProvider']))
+    engine = FaceSwapEngine(quantized_models=[], batch_window_ms=0,
+                            profiles={'source': ['detection', 'recognition']}).load()
+    feeds = []
+    if isinstance(model, RetinaFace):
+        det_model = engine.analyser.det_model
+        for _, img in images:
+            proxy, _ = detection_proxy(img, config.DET_PROXY_SIZE)
+            blob, _ = detection_blob(det_model, [proxy])
+            feeds.append({model.input_name: blob})
+        return feeds
+
+    faces = [(img, face) for _, img in images for face in engine.detect(img, profile='source')]
+    if isinstance(model, ArcFaceONNX):
+        for img, face in faces:
+            aimg = face_align.norm_crop(img, landmark=face.kps, image_size=model.input_size[0])
+            blob = cv2.dnn.blobFromImage(aimg, 1.0 / model.input_std, model.input_size,
+                                         (model.input_mean,) * 3, swapRB=True)
+            feeds.append({model.input_name: blob})
+    elif isinstance(model, INSwapper):
+        for i, (img, face) in enumerate(faces):
+            # 源人脸取下一张人脸，避免自己换自己
+            latent = engine.source_latent(faces[(i + 1) % len(faces)][1])
+            blob = engine.paste_template(img, face).blob
+            feeds.append({model.input_names[0]: blob, model.input_names[1]: latent})
+    else:
+        raise Exception(f"不支持量化校准的模型: {model_path}")
+    return feeds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='模型转换工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    dynamic = subparsers.add_parser('dynamic-batch', help='把 batch 维度固定为 1 的模型改写成动态 batch')
+    dynamic.add_argument('src')
+    dynamic.add_argument('dst')
+
+    quantize = subparsers.add_parser('quantize', help='生成 INT8 量化模型')
+    quantize.add_argument('src')
+    quantize.add_argument('dst', nargs='?', help='默认保存到量化模型目录下的同名文件')
+    quantize.add_argument('--mode', choices=['dynamic', 'static'], default='dynamic')
+    quantize.add_argument('--calib', help='静态量化的校准图片目录')
+    quantize.add_argument('--limit', type=int, default=64, help='最多使用的校准图片数')
+    quantize.add_argument('--per-channel', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'dynamic-batch':
+        make_dynamic_batch(args.src, args.dst)
+    else:
+        quantize_model(args.src, args.dst, mode=args.mode, calib_dir=args.calib,
+                       limit=args.limit, per_channel=args.per_channel)
@@ -0,0 +1,277 @@
+import base64
+import logging
+import os
+
+import cv2
+import numpy as np
+
+import config
+from encoding import JPEG_QUALITY, encode_results
+from engine import get_engine
+from ingest import decode_upload_image
+from role_index import RoleIndex
+from roles import catalog
+from source_cache import SourceEntry, SourceFaceCache, content_key
+
+logger = logging.getLogger(__name__)
+
+# 角色图片索引：目标图片的解码结果和人脸检测结果预先计算并保存到磁盘，随角色目录增量更新
+role_index = RoleIndex(catalog)
+
+# 换脸结果的后处理：轻微提升亮度和对比度 (alpha, beta)
+RESULT_ADJUST = (1.05, 3)
+# 源图片检测和特征提取前的亮度和对比度调整
+SOURCE_ADJUST = (1.1, 10)
+# 多人换脸自动对应人脸的方式：按位置 / 按特征相似度
+FACE_MATCH_MODES = ('position', 'similarity')
+
+# 源人脸缓存：同一张上传照片换不同角色时不再重复解码和检测
+source_cache = SourceFaceCache()
+
+
+def decode_image(data):
+    """把上传图片的原始字节解码成转正后的 BGR 图像
+
+    先检查文件头中的尺寸，过大的图片在解码前拒绝（ImageRejected）；大图在解码时直接缩小，见 ingest
+    """
+    return decode_upload_image(data)
+
+
+def decode_upload(source_img, source_is_base64=False):
+    """解码上传的源图片，返回 (BGR 图像, 缓存键)"""
+    if source_is_base64:
+        source_img = base64.b64decode(source_img.split('base64,')[1])
+    return decode_image(source_img), content_key(source_img)
+
+
+def load_source_face(engine, source_img, source_is_base64=False, cache_key=None):
+    """解码并检测源图片，返回带 latent 的 SourceEntry（包含所有人脸，上传内容相同时直接命中缓存）
+
+    source_img 可以是图片文件的原始字节、base64 data URL（source_is_base64=True）、文件路径，
+    或已经解码的 BGR 图像（此时由 cache_key 指定缓存键）
+    """
+    # 处理源图片
+    if source_is_base64:
+        source_img = base64.b64decode(source_img.split('base64,')[1])
+    if isinstance(source_img, bytes):
+        cache_key = content_key(source_img)
+    if cache_key is not None:
+        cached = source_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("源人脸缓存命中", extra={'cache_key': cache_key})
+            return cached
+
+    if isinstance(source_img, np.ndarray):
+        source = source_img
+    elif isinstance(source_img, bytes):
+        source = decode_image(source_img)
+    else:
+        source = cv2.imread(source_img)
+        if source is None:
+            raise Exception("无法加载源图片")
+        if len(source.shape) == 2:  # 如果是灰度图
+            source = cv2.cvtColor(source, cv2.COLOR_GRAY2BGR)
+
+    # 检测人脸：在缩小图上检测、在原图上对齐，不再把图片放大/缩小到 800~2000 像素；
+    # 亮度和对比度调整也只作用于检测缩小图和对齐后的人脸图块
+    source_faces = engine.detect(source, profile='source', adjust=SOURCE_ADJUST)
+    logger.info("源图片人脸检测完成", extra={'shape': source.shape, 'faces': len(source_faces)})
+
+    if len(source_faces) == 0:
+        # 保存问题图片以供分析
+        debug_path = "debug_source.jpg"
+        cv2.imwrite(debug_path, source)
+        raise Exception(f"未在源图片中检测到人脸，已保存问题图片到 {debug_path}")
+
+    # 所有人脸的 latent 一次算出，多人换脸可以直接使用同一个缓存条目
+    latents = engine.source_latents(source_faces)
+    if cache_key is None:
+        return SourceEntry(source_faces, latents, source.shape)
+    return source_cache.put(cache_key, source_faces, latents, source.shape)
+
+
+def swap_face(source_img, target, source_is_base64=False):
+    """换脸函数，返回 JPEG 编码后的字节
+
+    target 可以是目标图片路径，也可以是 role_index 中预先检测好的 RoleEntry
+    """
+    return swap_faces(source_img, [target], source_is_base64)[0]
+
+
+def swap_faces(source_img, targets, source_is_base64=False, cache_key=None, output=None):
+    """把同一张源图片换到多个目标上，返回与 targets 顺序一致的编码后字节列表（默认 JPEG）"""
+    images = render_faces(source_img, targets, source_is_base64, cache_key)
+    return [encoded.data for encoded in encode_results(images, output)]
+
+
+def render_faces(source_img, targets, source_is_base64=False, cache_key=None):
+    """把同一张源图片换到多个目标上，返回与 targets 顺序一致的结果图像（未编码）
+
+    源人脸只检测一次，所有目标人脸合并成一个 batch 交给 inswapper
+    """
+    # 使用进程内共享的引擎，模型只在启动时加载一次
+    engine = get_engine()
+
+    try:
+        source = load_source_face(engine, source_img, source_is_base64, cache_key)
+
+        templates = []
+        for target in targets:
+            # 读取目标图片，角色图片直接使用索引中的像素、人脸和贴回模板
+            if isinstance(target, str):
+                target_img = cv2.imread(target)
+                if target_img is None:
+                    raise Exception("无法加载目标图片")
+                target_faces = engine.detect(target_img, profile='target')
+                logger.info("目标图片人脸检测完成", extra={'shape': target_img.shape, 'faces': len(target_faces)})
+                if len(target_faces) == 0:
+                    raise Exception("未在目标图片中检测到人脸")
+                templates.append(engine.paste_template(target_img, target_faces[0], RESULT_ADJUST))
+            else:
+                templates.append(target.template(engine, RESULT_ADJUST))
+
+        # 执行换脸，贴回和亮度调整只处理人脸区域
+        results = engine.generate_batch(templates, source.latent)
+        # 确保结果不为空
+        if any(result is None for result in results):
+            raise Exception("换脸处理失败")
+        return results
+
+    except Exception as e:
+        logger.error("换脸处理错误", extra={'error': str(e)})
+        raise e
+
+
+def parse_face_mapping(value):
+    """解析多人换脸的人脸对应方式
+
+    'position' / 'similarity' 原样返回；"0:1,1:0" 形式解析为 [(源人脸序号, 目标人脸序号)]，
+    序号按人脸从左到右编号
+    """
+    if value in FACE_MATCH_MODES:
+        return value
+    try:
+        mapping = [tuple(int(i) for i in pair.split(':')) for pair in value.split(',')]
+    except ValueError:
+        mapping = None
+    if not mapping or any(len(pair) != 2 or min(pair) < 0 for pair in mapping):
+        raise Exception(f"无效的人脸对应方式: {value}")
+    return mapping
+
+
+def left_to_right(faces):
+    """按人脸中心从左到右排序，返回排序后的下标"""
+    return sorted(range(len(faces)), key=lambda i: faces[i].bbox[0] + faces[i].bbox[2])
+
+
+def greedy_match(scores):
+    """按分数从高到低贪心配对，每行、每列最多使用一次，返回 [(行, 列)]"""
+    rows, cols = np.unravel_index(np.argsort(-scores, axis=None, kind='stable'), scores.shape)
+    used_rows, used_cols = set(), set()
+    pairs = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        if row in used_rows or col in used_cols:
+            continue
+        pairs.append((row, col))
+        used_rows.add(row)
+        used_cols.add(col)
+        if len(pairs) == min(scores.shape):
+            break
+    return pairs
+
+
+def match_faces(source_faces, target_faces, mode, source_shape, target_shape):
+    """确定源人脸和目标人脸的对应关系，返回 [(源人脸下标, 目标人脸下标)]
+
+    mode 为 'position' 时按人脸中心在各自图片中的相对位置配对；为 'similarity' 时按特征向量的
+    余弦相似度配对（目标人脸需要有特征向量）；也可以直接给出 [(源人脸序号, 目标人脸序号)]，
+    序号按人脸从左到右编号。
+    """
+    if mode == 'position':
+        def centers(faces, shape):
+            bboxes = np.stack([face.bbox for face in faces])
+            return (bboxes[:, :2] + bboxes[:, 2:4]) / 2 / np.array([shape[1], shape[0]])
+        distances = np.linalg.norm(centers(source_faces, source_shape)[:, np.newaxis] -
+                                   centers(target_faces, target_shape)[np.newaxis], axis=2)
+        return greedy_match(-distances)
+    if mode == 'similarity':
+        similarity = np.stack([face.normed_embedding for face in source_faces]) @ \
+            np.stack([face.normed_embedding for face in target_faces]).T
+        return greedy_match(similarity)
+
+    source_order, target_order = left_to_right(source_faces), left_to_right(target_faces)
+    if any(s >= len(source_order) or t >= len(target_order) for s, t in mode):
+        raise Exception(f"人脸序号超出范围：源图片有 {len(source_order)} 个人脸，目标图片有 {len(target_order)} 个人脸")
+    return [(source_order[s], target_order[t]) for s, t in mode]
+
+
+def render_multi(source_img, targets, mode='position', source_is_base64=False, cache_key=None):
+    """多人换脸：源图片中的多个人脸按 mode 对应地换到每个目标图片的多个人脸上，
+    返回与 targets 顺序一致的结果图像（未编码）
+
+    target 可以是目标图片路径，也可以是 role_index 中的 RoleEntry；mode 见 match_faces。
+    源人脸和 latent 与单人换脸共用 source_cache；角色人脸的特征向量保存在角色索引中。
+    同一目标图片上的所有人脸在一个 batch 中推理，贴回依次叠加，亮度调整只处理人脸区域。
+    """
+    engine = get_engine()
+    source = load_source_face(engine, source_img, source_is_base64, cache_key)
+
+    results = []
+    for target in targets:
+        if isinstance(target, str):
+            target_img = cv2.imread(target)
+            if target_img is None:
+                raise Exception("无法加载目标图片")
+            target_faces = engine.detect(target_img, profile='target')
+            if len(target_faces) == 0:
+                raise Exception("未在目标图片中检测到人脸")
+            if mode == 'similarity':
+                engine.embed(target_img, target_faces)
+            # 同一张图片上的模板共用调整过亮度的背景
+            background = cv2.convertScaleAbs(target_img, alpha=RESULT_ADJUST[0], beta=RESULT_ADJUST[1])
+            make_template = lambda i: engine.paste_template(target_img, target_faces[i], RESULT_ADJUST, background)
+        else:
+            target_img = target.image
+            target_faces = target.embedded_faces(engine) if mode == 'similarity' else target.faces
+            make_template = lambda i: target.template(engine, RESULT_ADJUST, i)
+
+        pairs = match_faces(source.faces, target_faces, mode, source.shape, target_img.shape)
+        logger.info("多人换脸", extra={'source_faces': len(source.faces), 'target_faces': len(target_faces),
+                                    'pairs': pairs})
+        latents = source.latents[[s for s, _ in pairs]]
+        results.append(engine.generate_multi([make_template(t) for _, t in pairs], latents))
+    return results
+
+
+def result_signature(gender, role, faces=None, output=None):
+    """影响换脸结果的角色图片、流程参数和输出参数，任何一项变化时结果缓存自动失效"""
+    stat = os.stat(role_index.role_path(gender, role))
+    return repr((gender, role, stat.st_size, stat.st_mtime_ns,
+                 RESULT_ADJUST, SOURCE_ADJUST, JPEG_QUALITY,
+                 config.DET_SIZE, config.DET_THRESH, config.DET_PROXY_SIZE,
+                 config.QUANTIZED_MODELS, config.UPLOAD_DECODE_SIDE, config.ROLE_TARGET_MAX_SIDE, faces, output))
+
+
+def swap_roles(source_img, gender, roles, source_is_base64=False, cache_key=None, faces=None, output=None):
+    """把源图片换到指定性别下的多个角色上，返回 Encoded 列表（完整图片和预览图）
+
+    faces 不为空时使用多人换脸，取值见 match_faces；output 为 encoding.OutputOptions，为空时输出 JPEG
+    """
+    return encode_results(render_roles(source_img, gender, roles, source_is_base64, cache_key, faces), output)
+
+
+def render_roles(source_img, gender, roles, source_is_base64=False, cache_key=None, faces=None):
+    """与 swap_roles 相同，返回未编码的结果图像"""
+    engine = get_engine()
+    targets = [role_index.get(gender, role, engine) for role in roles]
+    if faces is not None:
+        return render_multi(source_img, targets, faces, source_is_base64, cache_key)
+    return render_faces(source_img, targets, source_is_base64, cache_key)
+
+
+def warm_up(engine=None):
+    """加载模型、建立角色索引并预先生成贴回模板，避免第一个请求等待；之后在后台跟踪角色目录的变化"""
+    engine = engine or get_engine()
+    role_index.build(engine).prepare_templates(engine, RESULT_ADJUST)
+    catalog.watch()
+    return engine
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from encoding import FORMATS, sniff_mimetype
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+# MIME 类型 -> 扩展名，文件扩展名与实际格式一致
+EXTENSIONS = {mimetype: extension for extension, mimetype, _ in FORMATS.values()}
+
+
+def result_key(upload_key, signature):
+    """换脸结果的缓存键：上传内容的哈希 + 角色和流程参数"""
+    return hashlib.sha1(f'{upload_key}|{signature}'.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """换脸结果的磁盘 LRU 缓存
+
+    每个结果保存为 <cache_dir>/<key>.<扩展名>（按图片格式为 .jpg / .webp / .png），
+    总大小超过 max_bytes 时删除最久未使用的结果。
+    命中时更新文件修改时间，重启后按修改时间恢复使用顺序。max_bytes 为 0 时不缓存。
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = 0
+        # key -> (文件大小, 扩展名)，最近使用的在末尾
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.enabled:
+            self._scan()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """读取缓存的结果，未命中时返回 None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            path = self.path(key, self._entries[key][1])
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # 文件被外部删除
+            with self._lock:
+                self._nbytes -= self._entries.pop(key, (0, None))[0]
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        suffix = EXTENSIONS.get(sniff_mimetype(data))
+        if not self.enabled or len(data) > self.max_bytes or suffix is None:
+            return
+        path = self.path(key, suffix)
+        # 先写临时文件再替换，避免读到写了一半的结果
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            old_size, old_suffix = self._entries.pop(key, (0, suffix))
+            self._nbytes += len(data) - old_size
+            self._entries[key] = (len(data), suffix)
+            # 同一个键换了格式时删除旧文件
+            removed = [key + old_suffix] if old_suffix != suffix else []
+            while self._nbytes > self.max_bytes:
+                old_key, (size, old_suffix) = self._entries.popitem(last=False)
+                self._nbytes -= size
+                removed.append(old_key + old_suffix)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._nbytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _scan(self):
+        """加载磁盘上已有的结果，按修改时间排序"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            key, suffix = os.path.splitext(name)
+            if suffix not in EXTENSIONS.values() or not KEY_PATTERN.match(key):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            files.append((stat.st_mtime, key, stat.st_size, suffix))
+        for _, key, size, suffix in sorted(files):
+            if key in self._entries:
+                # 同一个键有多个格式的文件时只保留最近写入的
+                self._nbytes -= self._entries[key][0]
+                os.remove(self.path(key, self._entries.pop(key)[1]))
+            self._entries[key] = (size, suffix)
+            self._nbytes += size
@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import threading
+
+import cv2
+
+import config
+from encoding import FORMATS, encode_image
+from ingest import read_header
+
+logger = logging.getLogger(__name__)
+
+
+class RoleThumbnails:
+    """角色图库的缩略图
+
+    每个角色按 widths 生成几种宽度的缩略图，宽度与 srcset 中的 w 描述一致；不放大，比原图宽的
+    宽度合并为一张原图宽度的缩略图。文件名为 <性别>.<角色>.<版本号>.<宽度>.<扩展名>，
+    版本号随图片、格式和质量变化，所以可以长期缓存；
+    角色图片变化时（见 roles.RoleCatalog）生成新版本并删除旧版本。
+    """
+
+    def __init__(self, catalog, cache_dir=None, widths=None, format=None, quality=None):
+        self.catalog = catalog
+        self.cache_dir = os.path.abspath(cache_dir or config.ROLE_THUMB_DIR)
+        self.widths = tuple(sorted(widths or config.ROLE_THUMB_WIDTHS))
+        self.format = format or config.ROLE_THUMB_FORMAT
+        self.quality = quality or config.ROLE_THUMB_QUALITY
+        # (性别, 角色) -> (已生成的版本号, [(宽度, 文件名)])
+        self._ready = {}
+        self._lock = threading.Lock()
+        catalog.subscribe(self._on_catalog_change)
+
+    def filename(self, gender, role, version, width):
+        return f'{gender}.{role}.{version}.{width}{FORMATS[self.format][0]}'
+
+    def prepare(self):
+        """为所有角色生成缺少的缩略图"""
+        for gender, gender_roles in self.catalog.roles.items():
+            for role in gender_roles:
+                self._ensure(gender, role)
+        return self
+
+    def describe(self, roles):
+        """在角色目录的每个角色上加上 thumbnail（最小宽度的缩略图）和 srcset，生成失败时只有原图 path"""
+        described = {}
+        for gender, gender_roles in roles.items():
+            described[gender] = {}
+            for role, info in gender_roles.items():
+                info = dict(info)
+                names = self._ensure(gender, role)
+                if names:
+                    urls = [(f'/roles/thumbs/{name}', width) for width, name in names]
+                    info['thumbnail'] = urls[0][0]
+                    info['srcset'] = ', '.join(f'{url} {width}w' for url, width in urls)
+                described[gender][role] = info
+        return described
+
+    def _version(self, gender, role):
+        # 版本号包含图片版本和缩略图参数，参数变化时旧文件会被替换
+        key = f'{self.catalog.version(gender, role)}|{self.format}|{self.quality}'
+        return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+    def _ensure(self, gender, role):
+        """返回 [(宽度, 文件名)]，缺少时生成"""
+        try:
+            version = self._version(gender, role)
+        except Exception:
+            return None
+        ready = self._ready.get((gender, role))
+        if ready is not None and ready[0] == version:
+            return ready[1]
+        with self._lock:
+            ready = self._ready.get((gender, role))
+            if ready is None or ready[0] != version:
+                try:
+                    path = self.catalog.path(gender, role)
+                    names = [(width, self.filename(gender, role, version, width))
+                             for width in self._thumbnail_widths(path)]
+                    if not all(os.path.exists(os.path.join(self.cache_dir, name)) for _, name in names):
+                        self._generate(path, names)
+                except Exception as e:
+                    logger.error("生成角色缩略图失败", extra={'gender': gender, 'role': role, 'error': str(e)})
+                    return None
+                self._remove(gender, role, keep=version)
+                ready = self._ready[(gender, role)] = (version, names)
+        return ready[1]
+
+    def _thumbnail_widths(self, path):
+        """该图片实际生成的宽度：小于原图宽度的配置宽度，其余合并为原图宽度"""
+        with open(path, 'rb') as f:
+            header = read_header(f.read())
+        if header is None:
+            raise Exception(f"无法读取角色图片尺寸: {path}")
+        _, width, height, orientation = header
+        # cv2.imread 会按 EXIF 方向转正，5~8 转正后宽高互换
+        if orientation in (5, 6, 7, 8):
+            width = height
+        widths = [w for w in self.widths if w < width]
+        if len(widths) < len(self.widths):
+            widths.append(width)
+        return widths
+
+    def _generate(self, path, names):
+        image = cv2.imread(path)
+        if image is None:
+            raise Exception(f"无法加载角色图片: {path}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        height, width = image.shape[:2]
+        for target_width, name in names:
+            thumbnail = image if target_width >= width else cv2.resize(
+                image, (target_width, max(1, round(height * target_width / width))), interpolation=cv2.INTER_AREA)
+            tmp_path = os.path.join(self.cache_dir, f'.{name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(encode_image(thumbnail, self.format, self.quality))
+            os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        logger.info("已生成角色缩略图", extra={'path': path, 'widths': [w for w, _ in names]})
+
+    def _remove(self, gender, role, keep=None):
+        """删除该角色其他版本的缩略图"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            parts = name.rsplit('.', 3)
+            if len(parts) == 4 and parts[0] == f'{gender}.{role}' and parts[1] != keep:
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def _on_catalog_change(self, added, removed, changed):
+        with self._lock:
+            for gender, role in removed:
+                self._ready.pop((gender, role), None)
+                self._remove(gender, role)
+        for gender, role in added + changed:
+            self._ensure(gender, role)
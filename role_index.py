@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+from insightface.app.common import Face
+
+import config
+from encoding import fit
+
+INDEX_PATH = './cache/role_index.npz'
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path):
+    """计算文件内容的 sha1，用于判断角色图片是否变化"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RoleEntry:
+    """单个角色的预处理结果：解码后的图片和检测到的人脸"""
+
+    def __init__(self, gender, role, path, digest, mtime, image, bboxes, kpss, scores, embeddings=None):
+        self.gender = gender
+        self.role = role
+        self.path = path
+        self.digest = digest
+        self.mtime = mtime
+        self.image = image
+        self.bboxes = bboxes
+        self.kpss = kpss
+        self.scores = scores
+        # 人脸特征向量（按相似度对应多人换脸时使用），建立索引时计算并保存
+        self.embeddings = embeddings
+        self._templates = {}
+
+    @property
+    def faces(self):
+        return [Face(bbox=self.bboxes[i], kps=self.kpss[i], det_score=self.scores[i],
+                     embedding=self.embeddings[i] if self.embeddings is not None else None)
+                for i in range(len(self.scores))]
+
+    @property
+    def face(self):
+        return self.faces[0]
+
+    def embedded_faces(self, engine):
+        """带特征向量的人脸；索引中没有特征向量时（未加载识别模型）计算一次并保留在内存中"""
+        if self.embeddings is None:
+            faces = engine.embed(self.image, self.faces)
+            self.embeddings = np.stack([face.embedding for face in faces]).astype(np.float32)
+        return self.faces
+
+    def template(self, engine, adjust=None, index=0):
+        """第 index 个人脸的对齐/贴回模板，首次使用时计算并缓存在内存中
+
+        同一个 adjust 的所有模板共用第一个人脸模板中调整好的背景
+        """
+        template = self._templates.get((adjust, index))
+        if template is None:
+            background = self.template(engine, adjust, 0).background if index else None
+            template = self._templates[(adjust, index)] = engine.paste_template(
+                self.image, self.faces[index], adjust, background)
+        return template
+
+
+class RoleIndex:
+    """角色图片索引
+
+    启动时（或离线执行 python role_index.py）对角色目录中的每张目标图片做一次
+    人脸检测，结果连同解码后的像素一起保存到 npz 文件。以文件内容哈希为键，
+    图片内容变化时自动重新检测，请求路径上不再需要读取和检测目标图片。
+    角色目录变化时（见 roles.RoleCatalog）只重新检测新增或修改的角色，删除的角色从索引中移除。
+    """
+
+    def __init__(self, catalog, index_path=INDEX_PATH):
+        self.catalog = catalog
+        self.index_path = index_path
+        self._entries = {}
+        self._engine = None
+        self._lock = threading.Lock()
+        catalog.subscribe(self._on_catalog_change)
+
+    def role_path(self, gender, role):
+        return self.catalog.path(gender, role)
+
+    def build(self, engine):
+        """加载已保存的索引，只对新增或内容变化的角色重新检测
+
+        检测失败的角色只记录日志，不影响其他角色，请求该角色时再报错
+        """
+        self._engine = engine
+        stored = self._load()
+        roles = self.catalog.roles
+        with self._lock:
+            self._entries = stored
+            changed = False
+            for gender, gender_roles in roles.items():
+                for role in gender_roles:
+                    try:
+                        changed |= self._update(engine, gender, role)[1]
+                    except Exception as e:
+                        logger.error("角色索引失败", extra={'gender': gender, 'role': role, 'error': str(e)})
+            # 已保存但不在角色目录中的角色
+            for key in [key for key, entry in self._entries.items() if entry.path is None]:
+                del self._entries[key]
+                changed = True
+            count = len(self._entries)
+        if changed:
+            self.save()
+        logger.info("角色索引已就绪", extra={'roles': count})
+        return self
+
+    def prepare_templates(self, engine, adjust=None):
+        """预先生成所有角色的贴回模板，避免第一次换某个角色时计算"""
+        for entry in list(self._entries.values()):
+            entry.template(engine, adjust)
+
+    def get(self, gender, role, engine):
+        """获取角色索引，图片文件被修改过时重新检测"""
+        self.catalog.refresh()
+        path = self.role_path(gender, role)
+        entry = self._entries.get((gender, role))
+        if entry is not None and entry.path == path and entry.mtime == os.path.getmtime(path):
+            return entry
+
+        with self._lock:
+            entry, changed = self._update(engine, gender, role)
+        if changed:
+            self.save()
+        return entry
+
+    def _update(self, engine, gender, role):
+        """按文件修改时间检查角色图片，内容变化时重新检测，返回 (索引, 是否有变化)；调用方持有锁"""
+        path = self.role_path(gender, role)
+        mtime = os.path.getmtime(path)
+        entry = self._entries.get((gender, role))
+        if entry is not None and entry.path == path and entry.mtime == mtime:
+            return entry, False
+        # 目标图片的最大边长计入哈希，修改后重新生成
+        digest = f'{file_digest(path)}-{config.ROLE_TARGET_MAX_SIDE}'
+        if entry is None or entry.digest != digest:
+            entry = self._index_role(engine, gender, role, path, digest)
+        entry.path = path
+        entry.mtime = mtime
+        self._entries[(gender, role)] = entry
+        return entry, True
+
+    def _on_catalog_change(self, added, removed, changed):
+        """角色目录变化：移除删除的角色；索引已经建立时立即检测新增和修改的角色"""
+        with self._lock:
+            updated = False
+            for key in removed:
+                updated |= self._entries.pop(key, None) is not None
+            if self._engine is not None:
+                for gender, role in added + changed:
+                    try:
+                        updated |= self._update(self._engine, gender, role)[1]
+                    except Exception as e:
+                        logger.error("角色索引失败", extra={'gender': gender, 'role': role, 'error': str(e)})
+        if updated:
+            self.save()
+
+    def _index_role(self, engine, gender, role, path, digest):
+        image = cv2.imread(path)
+        if image is None:
+            raise Exception(f"无法加载目标图片: {path}")
+        # 保存的是缩小到 ROLE_TARGET_MAX_SIDE 以内的副本，贴回和编码的耗时与原图尺寸无关
+        image = fit(image, config.ROLE_TARGET_MAX_SIDE)
+        faces = engine.detect(image, profile='target')
+        if len(faces) == 0:
+            raise Exception(f"未在目标图片中检测到人脸: {path}")
+        logger.info("索引角色", extra={'gender': gender, 'role': role, 'shape': image.shape, 'faces': len(faces)})
+        bboxes = np.stack([face.bbox for face in faces]).astype(np.float32)
+        kpss = np.stack([face.kps for face in faces]).astype(np.float32)
+        scores = np.array([face.det_score for face in faces], dtype=np.float32)
+        try:
+            engine.embed(image, faces)
+            embeddings = np.stack([face.embedding for face in faces]).astype(np.float32)
+        except Exception as e:
+            logger.warning("角色人脸特征提取失败", extra={'gender': gender, 'role': role, 'error': str(e)})
+            embeddings = None
+        return RoleEntry(gender, role, path, digest, os.path.getmtime(path),
+                         image, bboxes, kpss, scores, embeddings)
+
+    def save(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        arrays = {}
+        for entry in entries:
+            prefix = f'{entry.gender}.{entry.role}.'
+            arrays[prefix + 'digest'] = np.array(entry.digest)
+            arrays[prefix + 'image'] = entry.image
+            arrays[prefix + 'bboxes'] = entry.bboxes
+            arrays[prefix + 'kpss'] = entry.kpss
+            arrays[prefix + 'scores'] = entry.scores
+            if entry.embeddings is not None:
+                arrays[prefix + 'embeddings'] = entry.embeddings
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        # 先写临时文件再替换，避免并发读取到写了一半的索引；多个工作进程可能同时保存，临时文件按进程区分
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.index_path)
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            data = np.load(self.index_path, allow_pickle=False)
+        except Exception as e:
+            logger.warning("角色索引读取失败，将重新生成", extra={'error': str(e)})
+            return {}
+        entries = {}
+        with data:
+            for key in data.files:
+                if not key.endswith('.digest'):
+                    continue
+                gender, role = key[:-len('.digest')].split('.', 1)
+                prefix = f'{gender}.{role}.'
+                # 没有特征向量的旧索引按内容变化处理，重新检测一次
+                digest = str(data[key]) if prefix + 'embeddings' in data.files else ''
+                entries[(gender, role)] = RoleEntry(
+                    gender, role, None, digest, None,
+                    data[prefix + 'image'], data[prefix + 'bboxes'],
+                    data[prefix + 'kpss'], data[prefix + 'scores'],
+                    data[prefix + 'embeddings'] if prefix + 'embeddings' in data.files else None)
+        return entries
+
+
+if __name__ == '__main__':
+    # 离线生成角色索引：python role_index.py
+    from engine import get_engine
+    from logs import setup_logging
+    from roles import catalog
+
+    setup_logging()
+
+    RoleIndex(catalog).build(get_engine())
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 角色图片目录，位于 static 下由 Flask 直接提供；每个性别一个子目录
+ROLES_DIR = os.path.join(BASE_DIR, 'static', 'roles')
+# 会被当作角色图片的扩展名
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+# 角色视频目录，结构与角色图片目录相同，清单为 videos.json
+VIDEOS_DIR = os.path.join(BASE_DIR, 'static', 'videos')
+# 会被当作角色视频的扩展名
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv')
+
+
+class RoleCatalog:
+    """可选角色目录：性别 -> 角色 -> 图片路径（相对于项目目录的 URL）和显示名称
+
+    角色来自 <roles_dir>/<性别>/ 下的图片文件，角色 id 默认为文件名（不含扩展名）。
+    清单文件 roles.json 按 {"male": {"soldier": {"file": "soldier.jpg", "name": "军人"}}} 的格式
+    指定角色 id、显示名称和顺序，"enabled": false 的图片不出现在目录中；没有写进清单的图片
+    排在清单角色之后，显示名称为角色 id。清单中格式错误的条目记录日志后跳过（file 只能是文件名）。
+
+    读取 roles 时每隔 check_interval 秒检查一次清单和各图片文件的修改时间（只做 stat），
+    有变化时重新生成目录，并把新增、删除、内容变化的角色通知给 subscribe 注册的回调。
+    check_interval 为 0 时只在启动时读取一次。
+    角色视频使用同一个类，extensions 为视频扩展名，清单为 videos.json。
+    """
+
+    def __init__(self, roles_dir=ROLES_DIR, manifest_path=None, check_interval=None, extensions=IMAGE_EXTENSIONS):
+        self.roles_dir = roles_dir
+        self.manifest_path = manifest_path or os.path.join(roles_dir, 'roles.json')
+        self.extensions = extensions
+        self.check_interval = config.ROLE_CHECK_INTERVAL if check_interval is None else check_interval
+        self._manifest = (None, {})
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._watcher = None
+        self._roles, self._files = self._scan()
+        self._checked = time.monotonic()
+
+    @property
+    def roles(self):
+        self.refresh()
+        return self._roles
+
+    def path(self, gender, role):
+        """角色图片的文件路径（不触发检查）"""
+        try:
+            return self._files[(gender, role)][0]
+        except KeyError:
+            raise Exception(f"角色不存在: {gender}/{role}")
+
+    def version(self, gender, role):
+        """角色图片的版本号（按修改时间和大小生成，不触发检查），用于缓存文件名"""
+        try:
+            _, mtime, size = self._files[(gender, role)]
+        except KeyError:
+            raise Exception(f"角色不存在: {gender}/{role}")
+        return hashlib.sha1(f'{mtime}:{size}'.encode()).hexdigest()[:12]
+
+    def subscribe(self, listener):
+        """注册目录变化的回调 listener(新增, 删除, 变化)，参数为 [(性别, 角色)] 列表"""
+        self._listeners.append(listener)
+
+    def refresh(self, force=False):
+        """检查清单和角色图片是否变化，返回 (新增, 删除, 变化)；未到检查时间或没有变化时返回 None"""
+        if not force and (not self.check_interval or time.monotonic() - self._checked < self.check_interval):
+            return None
+        with self._lock:
+            if not force and time.monotonic() - self._checked < self.check_interval:
+                return None
+            roles, files = self._scan()
+            self._checked = time.monotonic()
+            if roles == self._roles and files == self._files:
+                return None
+            added = [key for key in files if key not in self._files]
+            removed = [key for key in self._files if key not in files]
+            changed = [key for key in files if key in self._files and files[key] != self._files[key]]
+            self._roles, self._files = roles, files
+        logger.info("角色目录已更新", extra={'added': added, 'removed': removed, 'changed': changed})
+        for listener in self._listeners:
+            try:
+                listener(added, removed, changed)
+            except Exception as e:
+                logger.error("角色目录更新回调失败", extra={'error': str(e)})
+        return added, removed, changed
+
+    def watch(self):
+        """启动后台线程定期检查，让新增或修改的角色在被请求之前就完成索引"""
+        if self.check_interval and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name='role-catalog', daemon=True)
+            self._watcher.start()
+        return self
+
+    def _watch(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.refresh(force=True)
+
+    def _read_manifest(self):
+        # 清单按修改时间缓存；格式错误时沿用上一次读取的内容，避免编辑过程中角色全部消失
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            self._manifest = (None, {})
+            return {}
+        if mtime != self._manifest[0]:
+            try:
+                with open(self.manifest_path, encoding='utf-8') as f:
+                    self._manifest = (mtime, self._validate(json.load(f)))
+            except (OSError, ValueError) as e:
+                logger.warning("角色清单读取失败", extra={'path': self.manifest_path, 'error': str(e)})
+        return self._manifest[1]
+
+    def _validate(self, manifest):
+        """检查清单结构，格式不对的性别或角色记录日志后跳过，不影响其他角色"""
+        if not isinstance(manifest, dict):
+            raise ValueError("清单应为 {性别: {角色: {...}}} 格式的对象")
+        valid = {}
+        for gender, configured in manifest.items():
+            if not isinstance(configured, dict):
+                logger.warning("角色清单中的性别格式错误，已跳过", extra={'path': self.manifest_path, 'gender': gender})
+                continue
+            valid[gender] = {}
+            for role, info in configured.items():
+                if not (isinstance(info, dict) and isinstance(info.get('file'), str)
+                        and info['file'] == os.path.basename(info['file']) and info['file']
+                        and isinstance(info.get('name', role), str)):
+                    logger.warning("角色清单中的角色格式错误，已跳过",
+                                   extra={'path': self.manifest_path, 'gender': gender, 'role': role, 'entry': info})
+                    continue
+                valid[gender][role] = info
+        return valid
+
+    def _scan(self):
+        manifest = self._read_manifest()
+        genders = list(manifest)
+        if os.path.isdir(self.roles_dir):
+            genders += sorted(entry.name for entry in os.scandir(self.roles_dir)
+                              if entry.is_dir() and entry.name not in manifest and not entry.name.startswith('.'))
+        roles, files = {}, {}
+        for gender in genders:
+            gender_dir = os.path.join(self.roles_dir, gender)
+            configured = manifest.get(gender, {})
+            found = [(role, info['file'], info.get('name', role))
+                     for role, info in configured.items() if info.get('enabled', True)]
+            listed = {info['file'] for info in configured.values()}
+            if os.path.isdir(gender_dir):
+                found += [(os.path.splitext(name)[0], name, os.path.splitext(name)[0])
+                          for name in sorted(os.listdir(gender_dir))
+                          if os.path.splitext(name)[1].lower() in self.extensions and name not in listed
+                          and not name.startswith('.')]
+            gender_roles = {}
+            for role, name, display_name in found:
+                path = os.path.join(gender_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    logger.warning("角色文件不存在", extra={'gender': gender, 'role': role, 'path': path})
+                    continue
+                if role in gender_roles:
+                    continue
+                gender_roles[role] = {
+                    'path': '/' + os.path.relpath(path, BASE_DIR).replace(os.sep, '/'),
+                    'name': display_name
+                }
+                files[(gender, role)] = (path, stat.st_mtime_ns, stat.st_size)
+            if gender_roles:
+                roles[gender] = gender_roles
+        return roles, files
+
+
+# 可选角色目录，catalog.roles 为 性别 -> 角色 -> {'path', 'name'}
+catalog = RoleCatalog()
+
+# 可选的角色视频，video_catalog.roles 格式与 catalog.roles 相同，path 为视频 URL
+video_catalog = RoleCatalog(VIDEOS_DIR, manifest_path=os.path.join(VIDEOS_DIR, 'videos.json'),
+                            extensions=VIDEO_EXTENSIONS)
@@ -0,0 +1,99 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from insightface.app.common import Face
+
+
+def content_key(data):
+    """上传内容的哈希，作为缓存键"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class SourceEntry:
+    """缓存的源人脸：源图片中的所有人脸（只保留换脸需要的字段）和预先计算好的 latent
+
+    face / latent 为第一个人脸，多人换脸使用 faces / latents（每行一个人脸）和源图片尺寸 shape
+    """
+
+    def __init__(self, faces, latents, shape):
+        self.faces = [Face(bbox=face.bbox, kps=face.kps, det_score=face.det_score,
+                           embedding=face.embedding) for face in faces]
+        self.latents = latents
+        self.shape = shape
+        self.nbytes = latents.nbytes + sum(v.nbytes for face in self.faces
+                                           for v in (face.bbox, face.kps, face.embedding))
+
+    @property
+    def face(self):
+        return self.faces[0]
+
+    @property
+    def latent(self):
+        return self.latents[:1]
+
+
+class SourceFaceCache:
+    """源人脸 LRU 缓存
+
+    同一张照片换不同角色时，跳过解码、检测和特征提取，直接进入生成阶段。
+    按条目数、内存占用和过期时间（秒）三个维度限制缓存大小。
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, ttl=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, faces, latents, shape):
+        entry = SourceEntry(faces, latents, shape)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.monotonic(), entry)
+            self._nbytes += entry.nbytes
+            while self._items and (len(self._items) > self.max_entries
+                                   or self._nbytes > self.max_bytes):
+                self._remove(next(iter(self._items)))
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self._nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def _remove(self, key):
+        _, entry = self._items.pop(key)
+        self._nbytes -= entry.nbytes
@@ -0,0 +1,203 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from insightface.app.common import Face
+
+import config
+from engine import get_engine
+from pipeline import RESULT_ADJUST, load_source_face
+
+logger = logging.getLogger(__name__)
+
+
+def track_keypoints(prev_gray, gray, kps, max_error=1.0):
+    """用 LK 光流把上一帧的关键点跟踪到当前帧
+
+    正向跟踪后再反向跟踪回上一帧，任一点丢失或往返误差超过 max_error 像素时返回 None
+    """
+    points = kps.reshape(-1, 1, 2).astype(np.float32)
+    params = dict(winSize=(21, 21), maxLevel=3)
+    tracked, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **params)
+    if tracked is None or not status.all():
+        return None
+    back, status_back, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, tracked, None, **params)
+    if back is None or not status_back.all():
+        return None
+    if np.linalg.norm(back - points, axis=2).max() > max_error:
+        return None
+    return tracked.reshape(-1, 2)
+
+
+class KeypointTracker:
+    """只在关键帧上检测目标人脸，中间帧用光流跟踪 5 个关键点；跟踪失败时立即重新检测"""
+
+    def __init__(self, engine, keyframe_interval):
+        self.engine = engine
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.detections = 0
+        self._gray = None
+        self._kps = None
+        self._since_keyframe = 0
+
+    def update(self, frame):
+        """返回当前帧目标人脸的关键点，没有人脸时返回 None"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        kps = None
+        if self._kps is not None and self._since_keyframe < self.keyframe_interval:
+            kps = track_keypoints(self._gray, gray, self._kps)
+        if kps is None:
+            faces = self.engine.detect(frame, profile='target')
+            self.detections += 1
+            self._since_keyframe = 0
+            if faces:
+                # 多个人脸时换最大的一个
+                kps = max(faces, key=lambda face: (face.bbox[2] - face.bbox[0]) *
+                          (face.bbox[3] - face.bbox[1])).kps
+        self._since_keyframe += 1
+        self._gray, self._kps = gray, kps
+        return kps
+
+
+def swap_frame(engine, frame, kps, latent):
+    template = engine.paste_template(frame, Face(kps=kps), RESULT_ADJUST)
+    return engine.generate_batch([template], latent)[0]
+
+
+def swap_video(source_img, video_path, output_path, source_is_base64=False,
+               keyframe_interval=None, workers=None, progress=None):
+    """把源图片中的人脸换到视频的每一帧上，结果写入 output_path
+
+    读帧、换脸、写帧分别在不同线程中流水执行：读帧线程用 cv2.VideoCapture 解码，
+    主线程做关键点跟踪并把每帧的换脸提交到线程池，写帧线程按顺序取结果交给 cv2.VideoWriter。
+    源人脸的特征和 latent 只计算一次。progress(已完成比例) 用于报告进度。
+    输出视频不包含音轨。
+    """
+    keyframe_interval = keyframe_interval or config.VIDEO_KEYFRAME_INTERVAL
+    workers = workers or config.VIDEO_WORKERS
+    engine = get_engine()
+    source = load_source_face(engine, source_img, source_is_base64)
+
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise Exception(f"无法打开视频: {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*config.VIDEO_FOURCC), fps, size)
+    if not writer.isOpened():
+        capture.release()
+        raise Exception(f"无法创建输出视频: {output_path}")
+
+    # 各阶段之间的队列有长度上限，避免解码过快时帧堆积在内存中
+    frames = queue.Queue(maxsize=workers * 4)
+    pending = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    errors = []
+    written = [0]
+
+    def on_written():
+        written[0] += 1
+        if progress is not None and total > 0:
+            progress(min(1.0, written[0] / total))
+
+    reader = threading.Thread(target=_read_frames, args=(capture, frames, stop),
+                              name='video-reader', daemon=True)
+    writer_thread = threading.Thread(target=_write_frames, args=(writer, pending, errors, on_written),
+                                     name='video-writer', daemon=True)
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='video-swap')
+    tracker = KeypointTracker(engine, keyframe_interval)
+    start = time.perf_counter()
+    reader.start()
+    writer_thread.start()
+    try:
+        while not errors:
+            try:
+                frame = frames.get(timeout=0.1)
+            except queue.Empty:
+                if not reader.is_alive() and frames.empty():
+                    raise Exception("读取视频帧的线程异常退出")
+                continue
+            if frame is None:
+                break
+            kps = tracker.update(frame)
+            if kps is None:
+                # 没有人脸的帧原样输出
+                future = Future()
+                future.set_result(frame)
+            else:
+                future = executor.submit(swap_frame, engine, frame, kps, source.latent)
+            pending.put(future)
+    finally:
+        stop.set()
+        pending.put(None)
+        writer_thread.join()
+        executor.shutdown()
+        reader.join()
+        capture.release()
+        writer.release()
+    if errors:
+        raise errors[0]
+
+    seconds = time.perf_counter() - start
+    logger.info("视频换脸完成", extra={'frames': written[0], 'detections': tracker.detections,
+                                   'seconds': round(seconds, 3),
+                                   'fps': round(written[0] / seconds, 2) if seconds > 0 else 0})
+    return output_path
+
+
+def _read_frames(capture, frames, stop):
+    while not stop.is_set():
+        ok, frame = capture.read()
+        if not ok:
+            break
+        _put_frame(frames, frame, stop)
+    # 结束标记也要能被 stop 打断，主循环提前退出时队列可能是满的
+    _put_frame(frames, None, stop)
+
+
+def _put_frame(frames, frame, stop):
+    while not stop.is_set():
+        try:
+            frames.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _write_frames(writer, pending, errors, on_written):
+    """按提交顺序写出换脸结果；出错后只记录第一个异常并继续取走剩余结果"""
+    while True:
+        future = pending.get()
+        if future is None:
+            return
+        try:
+            frame = future.result()
+        except Exception as e:
+            errors.append(e)
+            continue
+        if not errors:
+            writer.write(frame)
+            on_written()
+
+
+if __name__ == '__main__':
+    from logs import setup_logging
+
+    parser = argparse.ArgumentParser(description='视频换脸')
+    parser.add_argument('--source', required=True, help='源人脸图片')
+    parser.add_argument('--video', required=True, help='目标视频')
+    parser.add_argument('--output', required=True, help='输出视频路径（.mp4）')
+    parser.add_argument('--keyframe-interval', type=int, default=config.VIDEO_KEYFRAME_INTERVAL,
+                        help='每隔多少帧重新检测一次人脸')
+    parser.add_argument('--workers', type=int, default=config.VIDEO_WORKERS, help='换脸线程数')
+    args = parser.parse_args()
+
+    setup_logging()
+    swap_video(args.source, args.video, args.output,
+               keyframe_interval=args.keyframe_interval, workers=args.workers)
@@ -0,0 +1,213 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+from encoding import Encoded, encode_results
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """预先启动的换脸工作进程池
+
+    每个工作进程在启动时加载一次模型和角色索引，之后循环处理任务。
+    前端进程把解码后的源图片写入共享内存，任务队列里只传共享内存名称、形状和参数；
+    工作进程把编码后的结果也写入新建的共享内存块，前端读取后负责释放。
+    工作进程内推理和编码流水执行，一个任务的编码与下一个任务的推理同时进行。
+    工作进程意外退出时会自动重启，正在处理的任务以异常结束。
+    工作进程中各阶段的耗时和模型加载时间随结果一起返回，记录到前端进程的指标中。
+    """
+
+    def __init__(self, workers=2, onnx_threads=0):
+        self.workers = workers
+        # 未指定时把 CPU 核数平均分给各工作进程，避免多个进程的线程互相抢占
+        self.onnx_threads = onnx_threads or max(1, (os.cpu_count() or 1) // workers)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._tasks = None
+        self._results = None
+        self._processes = []
+        # task_id -> (Future, 输入共享内存)
+        self._pending = {}
+        # 各工作进程正在处理的任务编号，-1 表示空闲；进程崩溃时据此找到丢失的任务
+        # 每个进程两个位置：[2 * i] 为正在推理的任务，[2 * i + 1] 为正在编码的任务
+        self._current = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._dispatcher = None
+
+    def start(self):
+        """启动工作进程和结果分发线程，重复调用无副作用"""
+        with self._lock:
+            if self._processes:
+                return self
+            self._tasks = self._ctx.Queue()
+            self._results = self._ctx.Queue()
+            self._current = self._ctx.Array('q', [-1] * (2 * self.workers), lock=False)
+            self._processes = [self._spawn(i) for i in range(self.workers)]
+            self._dispatcher = threading.Thread(target=self._dispatch, name='worker-pool', daemon=True)
+            self._dispatcher.start()
+        return self
+
+    @property
+    def pending(self):
+        """已提交、尚未完成的任务数"""
+        with self._lock:
+            return len(self._pending)
+
+    def swap(self, image, cache_key, gender, roles, faces=None, output=None, timeout=None):
+        """在工作进程中换脸，返回与 roles 顺序一致的 Encoded 列表，faces、output 见 pipeline.swap_roles"""
+        self.start()
+        image = np.ascontiguousarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        np.ndarray(image.shape, image.dtype, buffer=shm.buf)[:] = image
+        future = Future()
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (future, shm)
+        self._tasks.put((task_id, shm.name, image.shape, image.dtype.str, cache_key, gender, list(roles), faces, output))
+        return future.result(timeout)
+
+    def _spawn(self, index):
+        process = self._ctx.Process(target=_worker_main, name=f'swap-process-{index}',
+                                    args=(index, self._tasks, self._results, self._current, self.onnx_threads),
+                                    daemon=True)
+        process.start()
+        return process
+
+    def _dispatch(self):
+        while True:
+            self._check_workers()
+            try:
+                message = self._results.get(timeout=1)
+            except queue.Empty:
+                continue
+            kind, task_id, payload, timings = message
+            for stage, seconds in timings:
+                metrics.STAGE_SECONDS.observe(seconds, stage=stage)
+            if kind == 'ready':
+                for model, seconds in payload.items():
+                    metrics.MODEL_LOAD_SECONDS.set(seconds, model=model)
+                continue
+            with self._lock:
+                pending = self._pending.pop(task_id, None)
+            if pending is None:
+                # 任务已按进程崩溃处理，丢弃迟到的结果
+                if kind == 'done':
+                    for main, preview in payload:
+                        _take_result(*main)
+                        if preview is not None:
+                            _take_result(*preview)
+                continue
+            future, shm = pending
+            _release(shm)
+            if kind == 'error':
+                future.set_exception(Exception(payload))
+            else:
+                future.set_result([Encoded(_take_result(*main), _take_result(*preview) if preview is not None else None)
+                                   for main, preview in payload])
+
+    def _check_workers(self):
+        """重启意外退出的工作进程，并让它正在处理的任务失败"""
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            logger.error("工作进程已退出，正在重启",
+                         extra={'worker': process.name, 'exitcode': process.exitcode})
+            for slot in (2 * index, 2 * index + 1):
+                task_id, self._current[slot] = self._current[slot], -1
+                with self._lock:
+                    lost = self._pending.pop(task_id, None)
+                if lost is not None:
+                    future, shm = lost
+                    _release(shm)
+                    future.set_exception(Exception("工作进程异常退出"))
+            self._processes[index] = self._spawn(index)
+
+
+def _release(shm):
+    shm.close()
+    shm.unlink()
+
+
+def _take_result(name, size):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        _release(shm)
+
+
+def _put_result(data):
+    if data is None:
+        return None
+    out = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    out.buf[:len(data)] = data
+    out.close()
+    return out.name, len(data)
+
+
+def _finish_task(task_id, images, output, timings, results, current, slot):
+    """在编码线程中编码结果并写入共享内存，与下一个任务的推理同时进行"""
+    try:
+        with metrics.collect() as encode_timings:
+            encoded = encode_results(images, output)
+        outputs = [(_put_result(item.data), _put_result(item.preview)) for item in encoded]
+        results.put(('done', task_id, outputs, timings + encode_timings))
+    except Exception as e:
+        results.put(('error', task_id, str(e), timings))
+    finally:
+        current[slot] = -1
+
+
+def _worker_main(index, tasks, results, current, onnx_threads):
+    """工作进程入口：加载模型后循环处理任务
+
+    推理和编码分成两级流水：一个任务推理完成后交给编码线程，主循环立即开始下一个任务的推理；
+    开始编码下一个任务前等待上一个任务编码完成，每个进程同时最多有一个任务在编码。
+    """
+    from engine import get_engine
+    from logs import setup_logging
+    from pipeline import render_roles, warm_up
+
+    setup_logging()
+    warm_up(get_engine(intra_op_threads=onnx_threads))
+    logger.info("工作进程已就绪", extra={'worker': index})
+    load_seconds = {key[0]: value for key, value in metrics.MODEL_LOAD_SECONDS.samples()}
+    results.put(('ready', None, load_seconds, []))
+
+    render_slot, encode_slot = 2 * index, 2 * index + 1
+    encoder = ThreadPoolExecutor(1, thread_name_prefix='finish')
+    finishing = None
+    while True:
+        task_id, name, shape, dtype, cache_key, gender, roles, faces, output = tasks.get()
+        current[render_slot] = task_id
+        shm = shared_memory.SharedMemory(name=name)
+        image = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        timings = []
+        try:
+            with metrics.collect() as timings:
+                images = render_roles(image, gender, roles, cache_key=cache_key, faces=faces)
+        except Exception as e:
+            images = None
+            results.put(('error', task_id, str(e), timings))
+        finally:
+            # 共享内存的视图必须先释放才能关闭
+            image = None
+            shm.close()
+        if images is None:
+            current[render_slot] = -1
+            continue
+        if finishing is not None:
+            finishing.result()
+        # 先登记到编码位置再清除推理位置，进程在两者之间崩溃时任务也不会丢失
+        current[encode_slot] = task_id
+        current[render_slot] = -1
+        finishing = encoder.submit(_finish_task, task_id, images, output, timings, results, current, encode_slot)